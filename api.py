@@ -1,11 +1,55 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from projects.clump_stylizer.curly_pipeline import generate_strands
+from projects.clump_stylizer.curly_pipeline import strands_to_lists, strands_to_binary, strands_prefix, write_outputs
+from projects.clump_stylizer.job_queue import JobQueue, QueueFull
+from projects.clump_stylizer.output_store import OutputStore
+from projects.clump_stylizer.result_cache import ResultCache, geometry_key
 from fastapi.staticfiles import StaticFiles
+from typing import Optional
+import asyncio
+import json
 import os
+import queue
+import struct
+import uuid
+import numpy as np
 
-app = FastAPI()
+# Tamanho do pool de geração e da fila de espera (além disso, 429)
+GENERATION_WORKERS = int(os.environ.get("CURLY_WORKERS", "2"))
+MAX_QUEUED_JOBS = int(os.environ.get("CURLY_MAX_QUEUED", "8"))
+# Cada requisição escreve em output/jobs/<hash>/, apagado depois de OUTPUT_TTL segundos sem uso
+OUTPUT_TTL = float(os.environ.get("CURLY_OUTPUT_TTL", "3600"))
+
+output_dir = os.path.join(os.path.dirname(__file__), "output")
+job_outputs = OutputStore(os.path.join(output_dir, "jobs"), ttl=OUTPUT_TTL)
+
+# Cache de geometria (LRU em memória, CURLY_CACHE_MB); CURLY_CACHE_DIR liga a camada em disco
+result_cache = ResultCache(
+    max_bytes=int(float(os.environ.get("CURLY_CACHE_MB", "512")) * 2**20),
+    disk_dir=os.environ.get("CURLY_CACHE_DIR") or None,
+)
+
+
+async def cleanup_outputs():
+    while True:
+        await asyncio.to_thread(job_outputs.cleanup)
+        app.state.jobs.prune(OUTPUT_TTL)
+        await asyncio.sleep(max(OUTPUT_TTL / 4, 1.0))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.jobs = JobQueue(workers=GENERATION_WORKERS, max_queued=MAX_QUEUED_JOBS)
+    cleaner = asyncio.create_task(cleanup_outputs())
+    yield
+    cleaner.cancel()
+    app.state.jobs.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Habilita CORS
 app.add_middleware(
@@ -16,7 +60,6 @@ app.add_middleware(
 )
 
 # Monta a pasta 'output' como estática (para acessar strands.obj/mtl)
-output_dir = os.path.join(os.path.dirname(__file__), "output")
 app.mount("/output", StaticFiles(directory=output_dir), name="output")
 
 # Monta a pasta 'data' como estática (para acessar scalpPath direto via URL)
@@ -29,23 +72,210 @@ class HairRequest(BaseModel):
     guidePath: str
     scalpPath: str
     groupingCSV: str
-    outputPath: str
+    # Opcional: só o nome do arquivo é usado; o par .obj/.mtl fica sempre na pasta do job (ver objUrl/mtlUrl)
+    outputPath: Optional[str] = None
     curliness: float
     length: float
     density: float
     color: str
+    # "json" devolve {"strands": [[[x, y, z], ...], ...]}, "binary" devolve o payload binário (ver file_io.pack_strands_binary)
+    responseFormat: str = "json"
+    quantize: bool = False
+    # Opcional: mesma semente, mesmos fios (cada raiz tem o próprio gerador, então o resultado não depende de density nem da ordem)
+    seed: Optional[int] = None
 
 
-@app.post("/generate")
-async def generate_hair(params: HairRequest):
-    strands = generate_strands(
-        guide_path=params.guidePath,
-        scalp_path=params.scalpPath,
-        grouping_csv=params.groupingCSV,
-        output_path=params.outputPath,
+def generation_kwargs(params: HairRequest) -> dict:
+    return dict(
+        guide_path=os.path.abspath(params.guidePath),
+        scalp_path=os.path.abspath(params.scalpPath),
+        grouping_csv=os.path.abspath(params.groupingCSV),
         curliness=params.curliness,
         length=params.length,
         density=params.density,
-        color=params.color
+        color=params.color,
+        seed=params.seed
     )
-    return {"strands": strands}
+
+
+def output_urls(output_path: str) -> dict:
+    rel = os.path.relpath(output_path, output_dir).replace(os.sep, "/")
+    return {"objUrl": f"/output/{rel}", "mtlUrl": f"/output/{rel[:-len('.obj')]}.mtl"}
+
+
+def strands_response(job, verts, indices, offsets):
+    params = job.meta["params"]
+    urls = job.meta["urls"]
+    if params.responseFormat == "binary":
+        return Response(content=strands_to_binary(verts, indices, offsets, params.quantize), media_type="application/octet-stream",
+                        headers={"X-Obj-Url": urls["objUrl"], "X-Mtl-Url": urls["mtlUrl"]})
+    return {"strands": strands_to_lists(verts, indices, offsets), **urls}
+
+
+async def submit_job(params: HairRequest, stream: bool = False) -> str:
+    kwargs = generation_kwargs(params)
+    for field, path in (("guidePath", kwargs["guide_path"]), ("scalpPath", kwargs["scalp_path"]), ("groupingCSV", kwargs["grouping_csv"])):
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail=f"{field} não encontrado: {getattr(params, field)}")
+    # saída isolada por requisição, endereçada pelo hash dos parâmetros; sem semente a geometria é aleatória, então
+    # cada requisição ganha a própria pasta (duas iguais sobrescreveriam o .obj uma da outra)
+    key_kwargs = kwargs if params.seed is not None else {**kwargs, "request": uuid.uuid4().hex}
+    obj_name = os.path.basename(params.outputPath) if params.outputPath else "strands.obj"
+    output_path = os.path.join(job_outputs.dir_for(OutputStore.key_for(key_kwargs)), obj_name)
+    kwargs["output_path"] = output_path
+    meta = {"params": params, "urls": output_urls(output_path)}
+
+    # geometria já gerada (talvez com outra cor): só reescreve o .mtl e reaproveita o .obj
+    geo_key = geometry_key(kwargs)
+    cached = result_cache.get(geo_key)
+    if cached is None and params.seed is not None and params.density < 1.0:
+        # com semente, qualquer densidade é um prefixo da geometria completa: basta fatiar
+        full = result_cache.get(geometry_key({**kwargs, "density": 1.0}))
+        if full is not None:
+            arrays = strands_prefix(*full.arrays(), params.density)
+            await asyncio.to_thread(write_outputs, *arrays, output_path, params.color)
+            return app.state.jobs.add_done(arrays, kwargs, meta)
+    if cached is not None:
+        await asyncio.to_thread(write_outputs, *cached.arrays(), output_path, params.color, cached.obj_path)
+        cached.obj_path = output_path
+        return app.state.jobs.add_done(cached.arrays(), kwargs, meta)
+
+    try:
+        job_id = app.state.jobs.submit(kwargs, meta=meta, stream=stream)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=f"Fila de geração cheia: {e}")
+
+    def store(future):
+        if not future.cancelled() and future.exception() is None:
+            result_cache.put(geo_key, *future.result(), obj_path=output_path)
+    find_job(job_id).future.add_done_callback(store)
+    return job_id
+
+
+def find_job(job_id: str):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job
+
+
+@app.post("/generate")
+async def generate_hair(params: HairRequest):
+    # a geração roda no pool de processos; o event loop só espera o resultado
+    job = find_job(await submit_job(params))
+    verts, indices, offsets = await asyncio.wrap_future(job.future)
+    return strands_response(job, verts, indices, offsets)
+
+
+# Modo progressivo: um "preview" (poucas raízes, vértices dizimados) e depois "chunk"s com os fios finais, conforme
+# ficam prontos; a união dos chunks é o resultado completo (a ordem dos fios é a de /generate só no .obj final)
+# json: uma linha (NDJSON) por evento; binary: quadros <tag de 4 bytes><tamanho uint32 LE><payload>, com os fios no
+# formato de file_io.pack_strands_binary e o quadro final "DONE"/"ERR " em JSON
+STREAM_TAGS = {"preview": b"PREV", "chunk": b"CHNK", "done": b"DONE", "error": b"ERR "}
+
+
+def stream_event(params: HairRequest, kind: str, verts=None, lengths=None, info: dict = None) -> bytes:
+    if verts is not None:
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        indices = np.arange(len(verts))
+        if params.responseFormat == "binary":
+            payload = strands_to_binary(verts, indices, offsets, params.quantize)
+        else:
+            info = {"strands": strands_to_lists(verts, indices, offsets)}
+    if params.responseFormat == "binary":
+        if verts is None:
+            payload = json.dumps(info).encode()
+        return STREAM_TAGS[kind] + struct.pack("<I", len(payload)) + payload
+    return (json.dumps({"type": kind, **info}) + "\n").encode()
+
+
+async def stream_chunks(job):
+    # lê a fila do job numa thread, sem travar o event loop; sem a marca de fim (worker morto), para quando o job termina
+    while True:
+        try:
+            item = await asyncio.to_thread(job.chunks.get, True, 0.5)
+        except queue.Empty:
+            if job.future.done():
+                return
+            continue
+        if item is None:
+            return
+        yield item
+
+
+async def stream_job(job):
+    params = job.meta["params"]
+    if job.chunks is not None:
+        async for kind, verts, lengths in stream_chunks(job):
+            yield stream_event(params, kind, verts, lengths)
+    try:
+        verts, indices, offsets = await asyncio.wrap_future(job.future)
+    except Exception as e:
+        yield stream_event(params, "error", info={"detail": str(e)})
+        return
+    if job.chunks is None: # veio do cache: tudo num chunk só
+        yield stream_event(params, "chunk", verts[indices], np.diff(offsets))
+    yield stream_event(params, "done", info={"strandCount": len(offsets) - 1, **job.meta["urls"]})
+
+
+@app.post("/generate/stream")
+async def generate_hair_stream(params: HairRequest):
+    job = find_job(await submit_job(params, stream=True))
+    media_type = "application/octet-stream" if params.responseFormat == "binary" else "application/x-ndjson"
+    return StreamingResponse(stream_job(job), media_type=media_type, headers={"X-Job-Id": job.job_id, "X-Obj-Url": job.meta["urls"]["objUrl"], "X-Mtl-Url": job.meta["urls"]["mtlUrl"]})
+
+
+@app.post("/jobs")
+async def create_job(params: HairRequest):
+    job_id = await submit_job(params)
+    return {**app.state.jobs.status(job_id), **find_job(job_id).meta["urls"]}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = find_job(job_id)
+    return {**app.state.jobs.status(job_id), **job.meta["urls"]}
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    # Server-Sent Events: os eventos do job (progress a cada 10%, summary com os tempos por etapa e as contagens),
+    # desde o início, e por fim um evento "status" com o estado final
+    job = find_job(job_id)
+
+    async def events():
+        sent = 0
+        while True:
+            finished = job.future.done()
+            new = await asyncio.to_thread(app.state.jobs.events_since, job_id, sent)
+            for event in new:
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            sent += len(new)
+            if finished:
+                yield f"event: status\ndata: {json.dumps(app.state.jobs.status(job_id))}\n\n"
+                return
+            await asyncio.sleep(0.25)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/metrics")
+async def metrics():
+    # Formato texto do Prometheus: totais por etapa dos jobs terminados, mais o estado atual da fila e do cache
+    jobs = app.state.jobs
+    cache = result_cache.stats()
+    gauges = {"jobs_active": jobs.active(), "jobs_tracked": len(jobs.jobs), "cache_entries": cache["entries"], "cache_bytes": cache["bytes"],
+              "cache_hits": cache["hits"], "cache_misses": cache["misses"]}
+    return PlainTextResponse(jobs.metrics.render(gauges))
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = find_job(job_id)
+    status = app.state.jobs.status(job_id)
+    if status["status"] == "failed":
+        raise HTTPException(status_code=500, detail=status["error"])
+    if status["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job ainda em andamento ({status['status']})")
+    verts, indices, offsets = app.state.jobs.result(job_id)
+    return strands_response(job, verts, indices, offsets)
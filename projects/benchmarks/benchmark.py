@@ -0,0 +1,243 @@
+# Times the hot paths of the pipeline on the bundled side swatch data, at its own size and with the scalp roots
+# synthetically multiplied, and appends the results to a JSON history so runs before and after a change can be compared
+
+import numpy as np
+import sys
+import os
+import csv
+import glob
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+script_dir = os.path.dirname(__file__)
+repo_dir = os.path.abspath(os.path.join(script_dir, '..', '..'))
+sys.path.append(os.path.join(repo_dir, 'src'))
+sys.path.append(os.path.join(repo_dir, 'projects', 'clump_stylizer'))
+
+import file_io as io
+import dft_testing as dft
+import octrees_lite as oct
+from instrumentation import stageTimer
+from wispify import WispifyEngine, WispParams, DEFAULT_AMPS, DEFAULT_ANGS, M1
+
+DATA_DIR = os.path.join(repo_dir, 'data')
+SCALP_OBJ = os.path.join(DATA_DIR, 'scalp_clouds', 'sideSwatchScalp.obj')
+GUIDE_ROOTS_OBJ = os.path.join(DATA_DIR, 'scalp_clouds', 'sideSwatchGuides.obj')
+DROOP_DIR = os.path.join(DATA_DIR, 'guide_strands', 'sideSwatchDroopSequence')
+GUIDE_OBJ = os.path.join(DROOP_DIR, '70.obj')
+GROUPING_CSVS = sorted(glob.glob(os.path.join(DATA_DIR, 'matching_csvs', '*.csv')), key = lambda path: int(path.rsplit('r', 1)[1].split('.')[0]))
+GROUPING_CSV = os.path.join(DATA_DIR, 'matching_csvs', 'sideSwatchGuides-sideSwatchScalp-groupingsr5.csv')
+DEFAULT_HISTORY = os.path.join(repo_dir, 'output', 'benchmarks', 'history.json') # kept out of the source tree
+
+class benchmarkRun:
+    """ Best and median wall times of named benchmarks, keyed "<name>@<scale>x" """
+    def __init__(self, repeats: int = 3):
+        self.repeats = repeats
+        self.results = {}
+
+    def time(self, name: str, scale: int, fn, repeats: int = None):
+        """ Calls <fn> <repeats> times (the run's default if not given), records the times and returns the last result"""
+        times = []
+        for _ in range(repeats if repeats is not None else self.repeats):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+        self.record(name, scale, times)
+        return result
+
+    def record(self, name: str, scale: int, times: list[float]):
+        key = f"{name}@{scale}x"
+        self.results[key] = {"best": min(times), "median": statistics.median(times), "repeats": len(times)}
+        print(f"{key:40s} best {min(times):9.4f}s  median {statistics.median(times):9.4f}s  ({len(times)}x)", flush = True)
+
+def scaled_roots(roots: np.ndarray, clumping: list[list[int]], scale: int, seed: int = 0) -> tuple[np.ndarray, list[list[int]]]:
+    """ <scale> jittered copies of every scalp root, each copy in the clump of its original"""
+    if scale == 1:
+        return roots, clumping
+    # jitter within a quarter of the typical spacing, so copies stay on the scalp and inside their root's region
+    _, d2 = oct.pointGrid(roots).query(roots, 2)
+    spacing = float(np.median(np.sqrt(d2[:, 1])))
+    rng = np.random.default_rng(seed)
+    copies = [roots] + [roots + rng.uniform(-0.25, 0.25, roots.shape)*spacing for _ in range(scale - 1)]
+    n = len(roots)
+    return np.concatenate(copies), [[r + c*n for c in range(scale) for r in group] for group in clumping]
+
+def write_inputs(out_dir: str, roots: np.ndarray, clumping: list[list[int]], scale: int) -> tuple[str, str]:
+    """ Writes the (scaled) scalp .obj and grouping .csv, returns their paths"""
+    scalp_path = os.path.join(out_dir, f"scalp{scale}x.obj")
+    csv_path = os.path.join(out_dir, f"grouping{scale}x.csv")
+    with open(scalp_path, "w", newline = "") as f:
+        np.savetxt(f, roots, fmt = "v %.9g %.9g %.9g")
+    with open(csv_path, "w", newline = "") as f:
+        csv.writer(f, delimiter = ",").writerows(clumping)
+    return scalp_path, csv_path
+
+def bench_io(run: benchmarkRun, scale: int, inputs: dict, text: bool):
+    """ file_io readers on the inputs, writers on a generated result; the .obj text round trip only when <text>"""
+    run.time("io.vert_read", scale, lambda: io.vert_read(inputs["scalp"], use_cache = False))
+    run.time("io.clumping_read", scale, lambda: io.clumping_read(inputs["csv"]))
+    if scale == 1:
+        run.time("io.read_obj_strands", 1, lambda: io.read_obj_strands(GUIDE_OBJ, use_cache = False))
+        run.time("io.clumping_read.r1-r30", 1, lambda: [io.clumping_read(path) for path in GROUPING_CSVS])
+        run.time("io.read_obj.droop", 1, lambda: [io.read_obj(path, use_cache = False) for path in glob.glob(os.path.join(DROOP_DIR, "*.obj"))], repeats = 1)
+    verts, indices, offsets = inputs["result"]
+    if text:
+        obj_path = os.path.join(inputs["dir"], f"result{scale}x.obj")
+        run.time("io.export_obj_csr", scale, lambda: io.export_obj_csr(verts, indices, offsets, obj_path), repeats = 1)
+        run.time("io.read_obj", scale, lambda: io.read_obj(obj_path, use_cache = False), repeats = 1)
+        os.remove(obj_path)
+    cache_path = os.path.join(inputs["dir"], f"result{scale}x{io.CACHE_SUFFIX}")
+    run.time("io.write_strand_cache", scale, lambda: io.write_strand_cache(cache_path, verts, indices, offsets))
+    run.time("io.open_strand_cache", scale, lambda: io.open_strand_cache(cache_path))
+    os.remove(cache_path)
+    run.time("io.pack_strands_binary", scale, lambda: io.pack_strands_binary(verts, indices, offsets))
+    run.time("io.pack_strands_binary.quantized", scale, lambda: io.pack_strands_binary(verts, indices, offsets, quantize = True))
+
+def bench_geometry(run: benchmarkRun, scale: int, inputs: dict, per_root: bool):
+    """ make_frames over the guides and get_centercurves over one guide copy per root, plus get_centercurve per root when <per_root>"""
+    v, edges = inputs["guides"]
+    strands = [v[e] for e in edges]
+    run.time("make_frames", scale, lambda: [io.make_frames(s, M1) for _ in range(scale) for s in strands])
+    # the rerooting builds one shifted guide per root, and takes each one's center curve
+    shifted = [s for s, group in zip(strands, inputs["clumping"]) for _ in group]
+    if per_root:
+        run.time("get_centercurve", scale, lambda: [dft.get_centercurve(s) for s in shifted], repeats = 1)
+    batches = [np.stack([shifted[j] for j in rows]) for rows in dft.length_groups([len(s) for s in shifted])]
+    run.time("get_centercurves", scale, lambda: [dft.get_centercurves(b) for b in batches])
+
+def bench_matching(run: benchmarkRun, scale: int, inputs: dict, octree: bool):
+    """ nearest guide queries for every root: the flat grid, and the legacy octree when <octree>"""
+    roots = inputs["roots"]
+    guide_roots = io.vert_read(GUIDE_ROOTS_OBJ)
+    k = 60 # prox_matcher's default neighbor set, 2*pullR
+    run.time("pointGrid.query", scale, lambda: oct.pointGrid(guide_roots).query(roots, k))
+    if octree:
+        sys.setrecursionlimit(32000)
+        tree = run.time("make_octree", scale, lambda: oct.make_octree(guide_roots, 2, np.max(guide_roots, axis = 0), np.min(guide_roots, axis = 0)))
+        diam = oct.average_leaf_diam(tree)
+        run.time("closest_guide_inds", scale, lambda: [oct.closest_guide_inds(v, tree, diam/2.0, min(k, len(guide_roots))) for v in roots], repeats = 1)
+
+def bench_wispify(run: benchmarkRun, scale: int, inputs: dict, seed: int) -> tuple:
+    """ the engine's stages on a cold pass, then the cached paths; returns the full result as (verts, indices, offsets)"""
+    timer = stageTimer()
+    engine = run.time("wispify.load", scale, lambda: WispifyEngine(GUIDE_OBJ, inputs["scalp"], inputs["csv"], DEFAULT_AMPS, DEFAULT_ANGS, timer), repeats = 1)
+    params = WispParams(curliness = 0.5, seed = seed)
+    first = []
+    start = time.perf_counter()
+    on_chunk = lambda kind, verts, lengths: first.append(time.perf_counter() - start) if not first else None
+    verts, edges = engine.generate(params, on_chunk = on_chunk, timer = timer)
+    run.record("wispify.cold", scale, [time.perf_counter() - start])
+    run.record("wispify.first_preview", scale, first)
+    for name, stage in timer.summary()["stages"].items():
+        if name != "load":
+            run.record(f"wispify.stage.{name}", scale, [stage["seconds"]])
+    run.time("wispify.cached", scale, lambda: engine.generate(params))
+    run.time("wispify.density_slice", scale, lambda: engine.generate(WispParams(curliness = 0.5, density = 0.5, seed = seed)))
+    run.time("wispify.curliness_change", scale, lambda: engine.generate(WispParams(curliness = 0.6, seed = seed)), repeats = 1)
+    indices, offsets = io.strands_to_csr(edges)
+    return verts, indices, offsets
+
+def bench_generate(run: benchmarkRun, scale: int, inputs: dict, seed: int):
+    """ POST /generate through the API (job pool included), cold and served from its cache"""
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError as e:
+        print(f"skipping /generate: {e}", flush = True)
+        return
+    sys.path.append(repo_dir)
+    import api
+    body = dict(guidePath = GUIDE_OBJ, scalpPath = inputs["scalp"], groupingCSV = inputs["csv"], curliness = 0.5, length = 1.0,
+                density = 1.0, color = "#000000", responseFormat = "binary", seed = seed)
+    with TestClient(api.app) as client:
+        # the first request pays for the worker process and its engine; the timed ones don't
+        client.post("/generate", json = {**body, "seed": seed + 1}).raise_for_status()
+        run.time("generate.cold", scale, lambda: client.post("/generate", json = body).raise_for_status(), repeats = 1)
+        run.time("generate.cached", scale, lambda: client.post("/generate", json = body).raise_for_status())
+        run.time("generate.json.cached", scale, lambda: client.post("/generate", json = {**body, "responseFormat": "json"}).raise_for_status(), repeats = 1)
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = repo_dir, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous: dict, results: dict, threshold: float, min_seconds: float) -> list[str]:
+    """ Benchmarks whose best time grew past <threshold> times the previous run's, ignoring ones under <min_seconds> (timer noise)"""
+    slower = []
+    for key, result in results.items():
+        before = previous["results"].get(key)
+        if before is None or before["best"] <= 0 or max(before["best"], result["best"]) < min_seconds:
+            continue
+        if result["best"]/before["best"] > threshold:
+            slower.append(f"{key}: {before['best']:.4f}s -> {result['best']:.4f}s ({result['best']/before['best']:.2f}x)")
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Timing the pipeline's hot paths on the bundled data, appending the results to a JSON history")
+    parser.add_argument("--scales", type = int, nargs = "+", default = [1, 10, 100], help = "Root multipliers to run at")
+    parser.add_argument("--heavyScale", type = int, default = 10, help = "Largest scale for the per-root loops (legacy octree, get_centercurve), the .obj text round trip and the end-to-end /generate")
+    parser.add_argument("--repeats", type = int, default = 3, help = "Runs per benchmark (the slow ones run once)")
+    parser.add_argument("--only", type = str, nargs = "+", choices = ["io", "geometry", "matching", "wispify", "generate"], default = None, help = "Run only these groups")
+    parser.add_argument("--seed", type = int, default = 1337, help = "Seed of the generated strands")
+    parser.add_argument("--history", type = str, default = DEFAULT_HISTORY, help = "JSON file the run is appended to")
+    parser.add_argument("--threshold", type = float, default = 1.25, help = "Slowdown over the previous run reported as a regression")
+    parser.add_argument("--minSeconds", type = float, default = 0.01, help = "Benchmarks faster than this in both runs aren't compared")
+    parser.add_argument("--check", action = "store_true", help = "Exit with an error when a regression is found")
+
+    args = parser.parse_args()
+    groups = set(args.only) if args.only is not None else {"io", "geometry", "matching", "wispify", "generate"}
+    run = benchmarkRun(args.repeats)
+
+    base_roots = io.vert_read(SCALP_OBJ)
+    base_clumping = io.clumping_read(GROUPING_CSV)
+    guides = io.read_obj_strands(GUIDE_OBJ)
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            roots, clumping = scaled_roots(base_roots, base_clumping, scale)
+            scalp_path, csv_path = write_inputs(tmp, roots, clumping, scale)
+            inputs = {"dir": tmp, "scalp": scalp_path, "csv": csv_path, "roots": roots, "clumping": clumping, "guides": guides}
+            print(f"--- {scale}x: {len(roots)} roots", flush = True)
+            if "io" in groups or "wispify" in groups:
+                # the writers need a generated result, so io always goes through the engine first
+                inputs["result"] = bench_wispify(run, scale, inputs, args.seed)
+            if "io" in groups:
+                bench_io(run, scale, inputs, text = scale <= args.heavyScale)
+            inputs.pop("result", None)
+            if "geometry" in groups:
+                bench_geometry(run, scale, inputs, per_root = scale <= args.heavyScale)
+            if "matching" in groups:
+                bench_matching(run, scale, inputs, octree = scale <= args.heavyScale)
+            if "generate" in groups and scale <= args.heavyScale:
+                bench_generate(run, scale, inputs, args.seed)
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    record = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": run.results,
+    }
+    slower = compare(history[-1], run.results, args.threshold, args.minSeconds) if history else []
+    history.append(record)
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok = True)
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent = 1)
+    print(f"appended to {args.history}", flush = True)
+
+    if slower:
+        print(f"{len(slower)} slower than the previous run (> {args.threshold}x):", flush = True)
+        for line in slower:
+            print(f"  {line}", flush = True)
+        if args.check:
+            sys.exit(1)
@@ -1,5 +1,37 @@
 import os
-import subprocess
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(script_dir)
+
+from wispify import WispifyEngine, WispParams, density_count
+from instrumentation import stageTimer
+import file_io as io
+
+# engines stay loaded between requests, keyed on their input files (path, mtime and size, so edits reload),
+# least recently used first; each holds its inputs plus stage caches of a few times its result geometry
+_engines = OrderedDict()
+MAX_ENGINES = int(os.environ.get("CURLY_MAX_ENGINES", "4"))
+
+def get_engine(guide_path: str, scalp_path: str, grouping_csv: str, timer: stageTimer = None) -> WispifyEngine:
+    """ Returns the loaded engine for these inputs, building it on first use"""
+    # a first use counts its loading under the "load" stage of <timer>
+    paths = (guide_path, scalp_path, grouping_csv)
+    key = tuple((path, *io.source_key(path)) for path in paths)
+    if key in _engines:
+        _engines.move_to_end(key)
+        return _engines[key]
+    # an engine over older versions of the same files can never be hit again
+    for stale in [k for k in _engines if tuple(entry[0] for entry in k) == paths]:
+        del _engines[stale]
+    while len(_engines) >= max(MAX_ENGINES, 1):
+        _engines.popitem(last=False)
+    _engines[key] = WispifyEngine(guide_path, scalp_path, grouping_csv, timer=timer)
+    return _engines[key]
 
 def hex_to_rgb_normalized(hex_color):
     hex_color = hex_color.lstrip("#")
@@ -9,7 +41,32 @@ def hex_to_rgb_normalized(hex_color):
     return r, g, b
 
 
-def generate_strands(
+def replace_atomically(write, path: str):
+    """ Calls write(tmp_path), then renames the result over <path> so readers never see a partial file"""
+    # API handlers share one process across threads, so the temp name is per thread as well as per process
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_mtl(mtl_path: str, color: str = "#000000"):
+    """ Writes the HairMaterial .mtl with the given hex color"""
+    replace_atomically(lambda path: _write_mtl(path, color), mtl_path)
+
+
+def _write_mtl(mtl_path: str, color: str):
+    r, g, b = hex_to_rgb_normalized(color)
+    with open(mtl_path, "w") as mtl_file:
+        mtl_file.write(f"""newmtl HairMaterial
+        Kd {r:.3f} {g:.3f} {b:.3f}
+        Ka 0.1 0.1 0.1
+        Ks 0.0 0.0 0.0
+        d 1.0
+        illum 1
+        """)
+
+
+def generate_strand_arrays(
     guide_path: str,
     scalp_path: str,
     grouping_csv: str,
@@ -17,84 +74,93 @@ def generate_strands(
     curliness: float = 0.5,
     length: float = 1.0,
     density: float = 1.0,
-    color="#000000"
+    color="#000000",
+    progress=None,
+    seed: int = None,
+    on_chunk=None,
+    timer: stageTimer = None
 ):
-    
-    wispify_script = os.path.join(
-        os.path.dirname(__file__),
-        "wispify.py"
-    )
-    
+    """ Runs the generation, writes the .obj/.mtl pair and returns the strands as (verts, indices, offsets)"""
+    # a given <seed> makes the geometry reproducible, root by root
+    # <on_chunk> receives the preview and refinement chunks as they are produced (see WispifyEngine.generate)
+    # <timer> collects the stage timings and counts, and gets a final "summary" event with all of them
     guide_path = os.path.abspath(guide_path)
     scalp_path = os.path.abspath(scalp_path)
     grouping_csv = os.path.abspath(grouping_csv)
     output_path = os.path.abspath(output_path)
-    wispify_script = os.path.abspath(wispify_script)
-
-    subprocess.run(
-        [
-            "python",
-            os.path.basename(wispify_script),
-            guide_path,
-            scalp_path,
-            grouping_csv,
-            output_path,
-            "--curliness", str(curliness),
-            "--length", str(length),
-            "--density", str(density),
-        ],
-        cwd=os.path.dirname(wispify_script),
-        check=True
-    )
-
-# Gerar o arquivo strands.mtl com a cor personalizada
-    r, g, b = hex_to_rgb_normalized(color)
-    mtl_path = output_path.replace(".obj", ".mtl")
-    with open(mtl_path, "w") as mtl_file:
-        mtl_file.write(f"""newmtl HairMaterial
-        Kd {r:.3f} {g:.3f} {b:.3f}
-        Ka 0.1 0.1 0.1
-        Ks 0.0 0.0 0.0
-        d 1.0
-        illum 1
-        """)
 
-    # Adicionar referência ao .mtl dentro do .obj
-    with open(output_path, "r") as obj_file:
-        lines = obj_file.readlines()
+    output_dir = os.path.dirname(output_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-    lines.insert(0, "mtllib strands.mtl\n")
-    lines.insert(1, "usemtl HairMaterial\n")
+    timer = timer if timer is not None else stageTimer()
+    engine = get_engine(guide_path, scalp_path, grouping_csv, timer)
+    styled_verts, styled_edges = engine.generate(WispParams(curliness=curliness, length=length, density=density, seed=seed), progress, on_chunk, timer)
+    with timer.stage("export"):
+        indices, offsets = io.strands_to_csr(styled_edges)
+        write_outputs(styled_verts, indices, offsets, output_path, color)
+    timer.emit("summary", **timer.summary())
+    return styled_verts, indices, offsets
 
-    with open(output_path, "w") as obj_file:
-        obj_file.writelines(lines)
 
+def write_outputs(verts, indices, offsets, output_path: str, color: str = "#000000", source_obj: str = None):
+    """ Writes the .obj/.mtl pair for already generated strands"""
+    # a <source_obj> written earlier for the same geometry is hard-linked (or copied) instead of formatted again,
+    # so a color-only change costs one .mtl write
+    output_path = os.path.abspath(output_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    mtl_path = output_path.replace(".obj", ".mtl")
+    write_mtl(mtl_path, color)
     print(f"Arquivo .mtl criado em {mtl_path}")
 
+    # the .obj references its .mtl by basename, so an earlier .obj is only reusable under the same basename
+    reusable = source_obj is not None and os.path.basename(source_obj) == os.path.basename(output_path) and os.path.exists(source_obj)
+    if not reusable:
+        # the .obj is written once, already referencing the .mtl, and the response comes from the arrays in memory
+        replace_atomically(lambda path: io.export_obj_csr(verts, indices, offsets, path, mtllib=os.path.basename(mtl_path), material="HairMaterial", precision=9), output_path)
+    elif os.path.abspath(source_obj) != output_path:
+        replace_atomically(lambda path: link_or_copy(source_obj, path), output_path)
+
 
+def link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError: # other filesystem, or no hard links here
+        shutil.copyfile(src, dst)
 
 
+def generate_strands(
+    guide_path: str,
+    scalp_path: str,
+    grouping_csv: str,
+    output_path: str,
+    curliness: float = 0.5,
+    length: float = 1.0,
+    density: float = 1.0,
+    color="#000000",
+    return_strands: bool = True,
+    seed: int = None
+):
+    verts, indices, offsets = generate_strand_arrays(guide_path, scalp_path, grouping_csv, output_path, curliness, length, density, color, seed=seed)
+    if not return_strands:
+        return None
+    return strands_to_lists(verts, indices, offsets)
 
 
-    strands = read_obj_strands(output_path)
-    return strands
+def strands_prefix(verts, indices, offsets, density: float):
+    """ The strands of a full-density result that <density> keeps, as (verts, indices, offsets)"""
+    # strands are generated in root priority order, so a lower density is always a prefix of a higher one
+    n = density_count(len(offsets) - 1, density)
+    end = offsets[n]
+    used = int(np.max(indices[:end])) + 1 if end > 0 else 0
+    return verts[:used], indices[:end], offsets[:n + 1]
 
 
-def read_obj_strands(filename: str):
-    import numpy as np
+def strands_to_lists(verts, indices, offsets):
+    """ Nested [[x, y, z], ...] lists per strand, the json response format"""
+    return [verts[indices[offsets[k]:offsets[k + 1]]].tolist() for k in range(len(offsets) - 1)]
 
-    strands = []
-    with open(filename, "r") as f:
-        current = []
-        for line in f:
-            if line.startswith("v "):
-                parts = line.strip().split()
-                x, y, z = map(float, parts[1:])
-                current.append([x, y, z])
-            elif line.startswith("o ") and current:
-                strands.append(current)
-                current = []
-        if current:
-            strands.append(current)
 
-    return strands
\ No newline at end of file
+def strands_to_binary(verts, indices, offsets, quantize: bool = False) -> bytes:
+    """ Packed binary response: header + float32 (or int16) positions + uint32 strand offsets"""
+    return io.pack_strands_binary(verts, indices, offsets, quantize)
@@ -0,0 +1,133 @@
+# Bounded process pool that runs strand generation away from the API's event loop
+
+import multiprocessing as mp
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(script_dir)
+
+from curly_pipeline import generate_strand_arrays
+from instrumentation import stageTimer, metricsRegistry
+
+class QueueFull(Exception):
+    """ Raised by JobQueue.submit when every worker is busy and the waiting line is full"""
+
+def _run_generate(job_id: str, kwargs: dict, progress, events, chunks=None) -> tuple:
+    # runs inside a pool worker; engines stay cached per worker process between jobs
+    def report(percent):
+        progress[job_id] = percent
+    def record(event):
+        events[job_id] = events[job_id] + [event] # a handful per job: progress every 10%, then the summary
+    timer = stageTimer(record)
+    if chunks is None:
+        return generate_strand_arrays(**kwargs, progress=report, timer=timer)
+    try:
+        return generate_strand_arrays(**kwargs, progress=report, timer=timer, on_chunk=lambda kind, verts, lengths: chunks.put((kind, verts, lengths)))
+    finally:
+        chunks.put(None) # end of the stream, whether the job finished or failed
+
+class GenerationJob:
+    def __init__(self, job_id: str, kwargs: dict, future, meta: dict = None, chunks=None):
+        self.job_id = job_id
+        self.kwargs = kwargs
+        self.future = future
+        self.meta = meta if meta is not None else {}
+        self.chunks = chunks # queue of (kind, verts, lengths) for streamed jobs, ended by None
+        self.submitted = time.time()
+
+class JobQueue:
+    """ Runs generate_strand_arrays jobs on <workers> processes, refusing new jobs past <max_queued> waiting ones"""
+    def __init__(self, workers: int = 2, max_queued: int = 8):
+        ctx = mp.get_context("spawn") # forking a server process that has threads running isn't safe
+        self.workers = workers
+        self.max_queued = max_queued
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        self.manager = ctx.Manager()
+        self.progress = self.manager.dict()
+        self.events = self.manager.dict() # job id -> the job's event dicts so far (see instrumentation.stageTimer)
+        self.metrics = metricsRegistry()
+        self.jobs = {}
+
+    def active(self) -> int:
+        return sum(1 for job in self.jobs.values() if not job.future.done())
+
+    def submit(self, kwargs: dict, meta: dict = None, stream: bool = False) -> str:
+        """ Queues one generation, returns its job id"""
+        # a <stream>ed job also hands its preview and refinement chunks over the job's chunks queue
+        if self.active() >= self.workers + self.max_queued:
+            raise QueueFull(f"{self.active()} jobs already running or queued")
+        job_id = uuid.uuid4().hex
+        self.progress[job_id] = 0
+        self.events[job_id] = []
+        chunks = self.manager.Queue() if stream else None
+        future = self.pool.submit(_run_generate, job_id, kwargs, self.progress, self.events, chunks)
+        self.jobs[job_id] = GenerationJob(job_id, kwargs, future, meta, chunks)
+        future.add_done_callback(lambda f: self.record_metrics(job_id, f))
+        return job_id
+
+    def record_metrics(self, job_id: str, future):
+        # called from the pool's thread as each job ends; the summary event carries its stage timings and counts
+        if future.cancelled():
+            self.metrics.record_job("cancelled")
+            return
+        try:
+            summaries = [e for e in self.events.get(job_id, []) if e["type"] == "summary"]
+        except (OSError, EOFError): # the manager is already gone (shutting down)
+            summaries = []
+        self.metrics.record_job("failed" if future.exception() is not None else "done", summaries[-1] if summaries else None)
+
+    def add_done(self, result: tuple, kwargs: dict, meta: dict = None) -> str:
+        """ Records a job that is already finished (e.g. served from cache), returns its job id"""
+        job_id = uuid.uuid4().hex
+        future = Future()
+        future.set_result(result)
+        self.progress[job_id] = 100
+        self.events[job_id] = []
+        self.jobs[job_id] = GenerationJob(job_id, kwargs, future, meta)
+        self.metrics.record_job("cached")
+        return job_id
+
+    def prune(self, max_age: float) -> int:
+        """ Forgets finished jobs submitted more than <max_age> seconds ago, returns how many went"""
+        cutoff = time.time() - max_age
+        stale = [job_id for job_id, job in self.jobs.items() if job.future.done() and job.submitted < cutoff]
+        for job_id in stale:
+            del self.jobs[job_id]
+            self.progress.pop(job_id, None)
+            self.events.pop(job_id, None)
+        return len(stale)
+
+    def get(self, job_id: str) -> GenerationJob:
+        return self.jobs.get(job_id)
+
+    def status(self, job_id: str) -> dict:
+        """ queued / running / done / failed, plus the percentage of guides generated"""
+        job = self.jobs[job_id]
+        if job.future.done():
+            error = job.future.exception()
+            state = "failed" if error is not None else "done"
+        else:
+            state = "running" if job.future.running() else "queued"
+            error = None
+        return {
+            "jobId": job_id,
+            "status": state,
+            "progress": self.progress.get(job_id, 0),
+            "error": None if error is None else str(error),
+        }
+
+    def events_since(self, job_id: str, start: int = 0) -> list[dict]:
+        """ The events job <job_id> has reported, from the <start>-th on"""
+        return self.events.get(job_id, [])[start:]
+
+    def result(self, job_id: str) -> tuple:
+        """ (verts, indices, offsets) of a finished job; re-raises the job's error if it failed"""
+        return self.jobs[job_id].future.result()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
@@ -0,0 +1,41 @@
+# Per-request output directories for generated .obj/.mtl pairs, addressed by a hash of the request
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+class OutputStore:
+    """ Hands out <root>/<key>/ directories and removes the ones untouched for longer than <ttl> seconds"""
+    def __init__(self, root: str, ttl: float = 3600.0):
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key_for(kwargs: dict) -> str:
+        """ Content address of a generation request: a hash of its canonical json"""
+        canonical = json.dumps(kwargs, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()[:24]
+
+    def dir_for(self, key: str) -> str:
+        path = os.path.join(self.root, key)
+        os.makedirs(path, exist_ok=True)
+        os.utime(path) # every use pushes the expiry back
+        return path
+
+    def cleanup(self, now: float = None) -> int:
+        """ Deletes expired directories, returns how many went"""
+        now = time.time() if now is None else now
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                expired = os.path.isdir(path) and now - os.path.getmtime(path) > self.ttl
+            except FileNotFoundError: # raced with another cleanup
+                continue
+            if expired:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
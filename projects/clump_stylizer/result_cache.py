@@ -0,0 +1,108 @@
+# LRU cache of generated strand geometry, with an optional on-disk tier in the binary strand cache format
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+script_dir = os.path.dirname(__file__)
+mymodules_dir = os.path.join(script_dir, '..','..','src')
+sys.path.append(mymodules_dir)
+
+import file_io as io
+
+# the parameters that change geometry; color only touches the .mtl
+GEOMETRY_PARAMS = ("curliness", "length", "density", "seed")
+
+def geometry_key(kwargs: dict) -> str:
+    """ Hash of the input files' identities (mtime, size) plus every geometry-affecting parameter"""
+    ident = {name: [kwargs[name], *io.source_key(kwargs[name])] for name in ("guide_path", "scalp_path", "grouping_csv")}
+    ident.update({name: kwargs.get(name) for name in GEOMETRY_PARAMS})
+    return hashlib.sha256(json.dumps(ident, sort_keys=True).encode()).hexdigest()[:24]
+
+class CachedStrands:
+    def __init__(self, verts, indices, offsets, obj_path: str = None):
+        self.verts = verts
+        self.indices = indices
+        self.offsets = offsets
+        self.obj_path = obj_path # an .obj already written for this geometry, if it still exists
+        self.nbytes = verts.nbytes + indices.nbytes + offsets.nbytes
+
+    def arrays(self) -> tuple:
+        return self.verts, self.indices, self.offsets
+
+class ResultCache:
+    """ Keeps up to <max_bytes> of strand arrays in memory, least recently used out first; <disk_dir> adds a second tier"""
+    def __init__(self, max_bytes: int = 512 * 2**20, disk_dir: str = None, max_disk_bytes: int = 4 * 2**30):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # puts arrive from the job pool's callback thread
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + io.CACHE_SUFFIX)
+
+    def get(self, key: str) -> CachedStrands:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        if self.disk_dir is not None:
+            arrays = io.open_strand_cache(self._disk_path(key))
+            if arrays is not None:
+                os.utime(self._disk_path(key)) # disk tier evicts by mtime
+                entry = CachedStrands(*arrays)
+                self._insert(key, entry)
+                with self.lock:
+                    self.hits += 1
+                return entry
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, verts, indices, offsets, obj_path: str = None):
+        self._insert(key, CachedStrands(verts, indices, offsets, obj_path))
+        if self.disk_dir is not None and not os.path.exists(self._disk_path(key)):
+            io.write_strand_cache(self._disk_path(key), verts, indices, offsets)
+            self._trim_disk()
+
+    def _insert(self, key: str, entry: CachedStrands):
+        with self.lock:
+            if entry.nbytes > self.max_bytes:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self.entries[key] = entry
+            self.total_bytes += entry.nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(io.CACHE_SUFFIX):
+                path = os.path.join(self.disk_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
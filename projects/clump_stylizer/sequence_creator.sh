@@ -0,0 +1,6 @@
+guideDir=../../data/guide_strands/sideSwatchDroopSequence
+scalpOBJ=../../data/scalp_clouds/sideSwatchScalp.obj
+groupingCSV=../../data/matching_csvs/sideSwatchGuides-sideSwatchScalp-groupingsr30.csv
+outputCache=../../data/full_strands/${1}.canim
+
+python3 wispify_sequence.py ${guideDir} ${scalpOBJ} ${groupingCSV} ${outputCache} --seed 1337
\ No newline at end of file
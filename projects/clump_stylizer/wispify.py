@@ -2,11 +2,11 @@
 
 import numpy as np
 import random
-import math
 import sys
 import os
-import datetime
 import argparse
+import copy
+from dataclasses import dataclass
 
 script_dir = os.path.dirname(__file__)
 mymodules_dir = os.path.join(script_dir, '..','..','src')
@@ -14,98 +14,18 @@ sys.path.append(mymodules_dir)
 
 import file_io as io
 import dft_testing as dft
+import spectrum_library as spec
+import splines
+from instrumentation import stageTimer, print_event
 
-def distance_accumulate(pts):
-    ds = np.empty(len(pts))
-    ds[0] = 0
-    for i in range(1,len(ds)):
-        ds[i] = ds[i-1] + np.linalg.norm(pts[i] - pts[i-1])
-    return ds
-
-def bez(v0, m0, v1, m1, ts):
-    t3 = ts**3
-    t2 = ts**2
-    vs = np.empty((len(ts), 3))
-    for i in range(3):
-        vs[:,i] = v0[i] * (2 * t3 - 3 * t2 + 1) + m0[i] * (t3 - 2 * t2 + ts) + v1[i] * (3 * t2 - 2 * t3) + m1[i] * (t3 - t2)
-    return vs
-
-def even_bez(v0, m0, v1, m1, res):
-    ts = np.linspace(0,1,res)
-    pts = bez(v0, m0, v1, m1, ts)
-    distances = distance_accumulate(pts)
-    even_distances = np.linspace(0, distances[-1], res)
-    even_times = np.interp(even_distances, distances, ts)
-    return bez(v0, m0 ,v1, m1, even_times)
+DEFAULT_AMPS = os.path.join(script_dir, '..', '..', 'data', 'amp_angle_stats', 'fullCombStats', 'fullComb.objAmps.npz')
+DEFAULT_ANGS = os.path.join(script_dir, '..', '..', 'data', 'amp_angle_stats', 'fullCombStats', 'fullComb.objAngs.npz')
 
 def curve_interp(curve_0: np.ndarray[np.ndarray], curve_1: np.ndarray[np.ndarray]) -> np.ndarray[np.ndarray]:
     assert curve_0.shape == curve_1.shape, f"curve's shapes don't match: c0: {curve_0.shape} | c1: {curve_1.shape}"
     ts = np.linspace(0,1,len(curve_0))
     return np.transpose(ts*np.transpose(curve_1) + (1-ts)*np.transpose(curve_0))
 
-def catmull(vs, ts):
-    cats = np.empty((len(ts), 3))
-    if len(vs) == 1:
-        for i in range(0,len(cats)):
-            cats[i] = vs[0][:]
-        return cats
-    if len(cats) == 2:
-        for i, t in enumerate(ts):
-            cats[i] = (1-t)*vs[0] + t*vs[1]
-        return cats
-    if len(cats) == 3:
-        for i, t in enumerate(ts):
-            scaled = 2*t
-            low = int(math.floor(scaled))
-            high = int(math.ceil(scaled))
-            if low == high:
-                cats[i] = vs[low]
-                continue
-            if low == 0:
-                m0 = vs[2] - vs[0] - 0.5*(vs[2] - vs[1])
-            else:
-                m0 = 0.5*(vs[2] - vs[0])
-            if high == 2:
-                m1 = vs[high] - vs[high - 2] - 0.5*(vs[high - 1] - vs[high - 2])
-            else: 
-                m1 = 0.5*(vs[2] - vs[0])
-            real_t = scaled - low
-            t3 = real_t**3
-            t2 = real_t**2
-            cats[i] = vs[low] * (2 * t3 - 3 * t2 + 1) + m0 * (t3 - 2 * t2 + real_t) + vs[high] * (3 * t2 - 2 * t3) + m1 * (t3 - t2)
-        return cats
-
-    for i, t in enumerate(ts):
-        scaled = t*(len(vs)-1)
-        low = int(math.floor(scaled))
-        high = int(math.ceil(scaled))
-        if low == high:
-            cats[i] = vs[low]
-            continue
-        if low == 0:
-            m0 = vs[2] - vs[0] - 0.5 * (vs[3] - vs[1])
-        else:
-            m0 = 0.5*(vs[low + 1] - vs[low - 1])
-        if high == len(vs) - 1:
-            m1 = vs[high] - vs[high - 2] - 0.5*(vs[high-1] - vs[high-3])
-        else:
-            m1 = 0.5*(vs[high + 1] - vs[high - 1])
-        real_t = scaled - low
-        t3 = real_t**3
-        t2 = real_t**2
-        cats[i] = vs[low] * (2 * t3 - 3 * t2 + 1) + m0 * (t3 - 2 * t2 + real_t) + vs[high] * (3 * t2 - 2 * t3) + m1 * (t3 - t2)
-    return cats
-
-# resamples catmull spline with t_max in (0, 1] cutoff
-def even_catmull(vs, res, t_max):
-    ts = np.linspace(0, t_max, res)
-    pts = catmull(vs, ts)
-    distances = distance_accumulate(pts)
-    even_distances = np.linspace(0, distances[-1], res)
-    even_times = np.interp(even_distances, distances, ts)
-    return catmull(vs, even_times)
-
-# takes array elements and drops them out with some probability
 def dropout(vs, prob):
     accum = []
     for v in vs:
@@ -137,7 +57,7 @@ def rerooted_curl(v0, m0, dropout_p, t_s, c_d, qs, up):
     prox_len = np.linalg.norm(v_cut-v0)
     m0 = m0/np.linalg.norm(m0)*prox_len
     m_cut = m_cut/np.linalg.norm(m_cut)*prox_len
-    spine = even_bez(v0, m0, v_cut, m_cut, cutoff + 1) #cutoff + 1 here since it's length of array that is from 0->cutoff
+    spine = splines.even_bez(v0, m0, v_cut, m_cut, cutoff + 1) #cutoff + 1 here since it's length of array that is from 0->cutoff
     # spine = curve_interp(center_curve[:cutoff + 1] + (v0 - center_curve[0]), center_curve[:cutoff + 1])
     # spine = curve_interp(spine, center_curve[:cutoff+1])
     wrapped = dft.wind_displacements(spine, c_d, up)
@@ -153,6 +73,34 @@ def rerooted_curl(v0, m0, dropout_p, t_s, c_d, qs, up):
         return wrapped
     return np.append(wrapped, post, axis = 0)
 
+# rerooted_curl for a stack of shifted copies <qs> (k, n, 3) of one guide, with their <centers>, one root <v0s>,
+# tL draw, displacement and dropout draw row each; the spines are built and wound as one stack padded to the longest cutoff
+def rerooted_curl_batch(v0s, dropout_p, t_ss, c_ds, qs, up, centers, drops) -> list[np.ndarray]:
+    k, n = qs.shape[:2]
+    if n < 6:
+        return list(qs + (v0s - qs[:, 2])[:, None])
+    cutoffs = np.array([min(max(int(t_s*n), 3), len(c_d) - 1) for t_s, c_d in zip(t_ss, c_ds)]) #the INDEX to which all the displacements get applied
+    rows = np.arange(k)
+    ends = cutoffs == n - 1
+    m_cut = 0.5*(centers[rows, np.minimum(cutoffs + 1, n - 1)] - centers[rows, cutoffs - 1])
+    m_cut[ends] = centers[ends, -1] - centers[ends, -2]
+    v_cut = centers[rows, cutoffs]
+    m0 = centers[rows, cutoffs//2] - v0s # REALLY short wisps leads to sampling into rooted portion (during sim)
+    flip = np.sum(m0*(centers[:, -1] - v0s), axis = 1) < 0.0 # so do an alignment check
+    m0[flip] = qs[flip, -1] - v0s[flip] # and fall back to just a lazy solution
+    prox_len = io.row_norms(v_cut - v0s)
+    m0 = m0/io.row_norms(m0)*prox_len
+    m_cut = m_cut/io.row_norms(m_cut)*prox_len
+    spines = splines.even_bez_padded(v0s, m0, v_cut, m_cut, cutoffs + 1)
+    width = spines.shape[1]
+    ds = np.zeros((k, width, c_ds[0].shape[1]))
+    for j, c in enumerate(cutoffs):
+        ds[j, :c + 1] = c_ds[j][:c + 1]
+    wrapped = dft.wind_displacements_batch(spines, ds, up, cutoffs + 1)
+    wrapped[:, 0] = v0s
+    keep = drops[:, :n] > dropout_p
+    return [np.append(wrapped[j, :c + 1], qs[j, c + 1:][keep[j, :n - c - 1]], axis = 0) for j, c in enumerate(cutoffs)]
+
 # each np.ndarray has mismatched shape[0] but is otherwise same
 # want to consolidate into (sum of all shape[0]s, <remaining dimensions>) np.ndarray
 def numpy_flat(weirdo: list[np.ndarray]) -> np.ndarray:
@@ -167,6 +115,335 @@ def numpy_flat(weirdo: list[np.ndarray]) -> np.ndarray:
             m += 1
     return fin
 
+@dataclass
+class WispParams:
+    """ Stylization parameters for one generation pass (mirrors the command line flags)"""
+    curliness: float = 0.0
+    length: float = 1.0
+    density: float = 1.0
+    tl_rand: tuple[float, float] = (0.1, 0.6)
+    len_rand: tuple[float, float] = (0.8, 1.0)
+    wisp_r: tuple[float, float] = (0.07, 0.35)
+    dropout: float = 0.5
+    seed: int | None = None # fixes every random draw; None draws fresh entropy per pass
+
+# random streams are keyed on (seed, stream, index) so a root sees the same draws no matter what else gets generated
+ROOT_STREAM = 1
+PRIORITY_STREAM = 2
+
+def stream_rng(seed: int, stream: int, index: int) -> np.random.Generator:
+    return np.random.default_rng([seed, stream, index])
+
+M1 = np.array([-5, 5, 0]) # the up vector shared by framing, shifting and winding
+
+def density_count(n_roots: int, density: float) -> int:
+    """ How many strands of the priority order a density keeps"""
+    return int(round(min(max(density, 0.0), 1.0) * n_roots))
+
+# progressive generation: the preview holds this fraction of the kept strands with every PREVIEW_STEP-th vertex,
+# and refinement chunks are sent every CHUNK_GUIDES guides
+PREVIEW_FRACTION = 0.1
+PREVIEW_STEP = 4
+CHUNK_GUIDES = 8
+
+def emit_wisps(kind: str, pending: list[tuple[np.ndarray, list[int], np.ndarray]], on_chunk):
+    """ Sends the (verts, lens, kept flags or None) wisps of some guides to <on_chunk> as one (kind, verts, lengths) chunk"""
+    verts = []
+    lengths = []
+    for wisp_verts, wisp_lens, kept in pending:
+        if kept is None:
+            kept = np.ones(len(wisp_lens), dtype = bool)
+        starts = np.concatenate([[0], np.cumsum(wisp_lens)])
+        verts.extend(wisp_verts[starts[k]:starts[k + 1]] for k in np.flatnonzero(kept))
+        lengths.extend(wisp_lens[k] for k in np.flatnonzero(kept))
+    on_chunk(kind, np.concatenate(verts) if verts else np.empty((0, 3)), np.array(lengths, dtype = np.int64))
+
+def priority_gather(guide_verts: list[np.ndarray], guide_lens: list[int], priorities: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Reorders wisps built guide by guide into ascending <priorities> (one per wisp), as (verts, strand offsets)"""
+    if len(guide_lens) == 0:
+        return np.empty((0, 3)), np.zeros(1, dtype = np.int64)
+    lens = np.array(guide_lens, dtype = np.int64)
+    starts = np.concatenate([[0], np.cumsum(lens)[:-1]])
+    order = np.argsort(priorities, kind = "stable")
+    offsets = np.concatenate([[0], np.cumsum(lens[order])])
+    gather = np.repeat(starts[order] - offsets[:-1], lens[order]) + np.arange(offsets[-1])
+    return np.concatenate(guide_verts)[gather], offsets
+
+# every stage of one guide's wisps, in pipeline order; a stage is recomputed only when its key changes.
+# curliness and length move the guide itself, so the reroot and resample stages (nearly all of a pass) rerun for
+# them and only the draws (and for length, the curl displacements) are reused; density and color reuse everything
+STAGES = ("guide", "draws", "curl", "reroot", "resample")
+# the timer each stage's computation is counted under
+STAGE_TIMERS = {"guide": "frames", "draws": "draws", "curl": "fft", "reroot": "reroot", "resample": "resample"}
+
+class WispifyEngine:
+    """ Keeps the guide strands, scalp, clumping map and spectra in memory so repeated generation skips all file loading"""
+    def __init__(self, input_obj: str, scalp_file: str, clumping_file: str, amps_file: str = DEFAULT_AMPS, angs_file: str = DEFAULT_ANGS, timer: stageTimer = None):
+        # an <angs_file> of None reads <amps_file> as a packed spectra file (spectrum_exporter's default output)
+        # the loading is timed as the "load" stage of <timer>, if given
+        self.timer = timer if timer is not None else stageTimer()
+        with self.timer.stage("load"):
+            self.spectra = spec.load_library(amps_file, angs_file) # shared by every engine of this process
+
+            # load strand(s)
+            self.v, self.e = io.read_obj_strands(input_obj)
+            # load scalp
+            self.v_scalp = io.vert_read(scalp_file)
+            # load clumping dictionary
+            self.clumping_map = io.clumping_read(clumping_file)
+
+        # stage name -> {guide index: (key, value)}, holding the latest result of each stage per guide
+        self.stages = {name: {} for name in STAGES}
+        self.full = None # (key, verts, offsets) of the latest full-density result
+        self.priorities = None # (seed, {root: priority draw})
+
+    def for_guides(self, input_obj: str) -> "WispifyEngine":
+        """ An engine over another guide file (e.g. the next frame of a sequence) sharing this one's scalp, clumping and spectra"""
+        # the per-root draws and displacements only depend on the seed and the guide lengths, so they are shared as well
+        engine = copy.copy(self)
+        engine.v, engine.e = io.read_obj_strands(input_obj)
+        engine.stages = {name: self.stages[name] if name in ("draws", "curl") else {} for name in STAGES}
+        engine.full = None
+        return engine
+
+    def generate(self, params: WispParams, progress = None, on_chunk = None, timer: stageTimer = None) -> tuple[np.ndarray, list[np.ndarray]]:
+        """ Runs the stylization over every guide, returns the flattened verts and per-strand index arrays"""
+        # <progress>, if given, is called with the percentage of guides done
+        # <timer>, if given, collects the time of every stage (see STAGE_TIMERS), the counts and the progress events
+        # <on_chunk>, if given, is called as on_chunk(kind, verts, lengths) while the pass runs: first once with a
+        # "preview" of decimated strands, then with "chunk"s of final strands that together are the whole result
+        # with a fixed seed, a pass reuses every stage whose inputs did not change since the last one (see STAGES)
+        # strands come out in root priority order and density keeps a prefix of them, so with a seed any density is a
+        # slice of one cached full result; without one the seed is fresh and never reused, so only the kept roots are built
+        self.timer = timer if timer is not None else stageTimer()
+        seed = params.seed if params.seed is not None else np.random.SeedSequence().entropy
+        roots = [root for group in self.clumping_map for root in group]
+        n = density_count(len(roots), params.density)
+        kept = None
+        if on_chunk is not None or params.seed is None:
+            ranks = np.empty(len(roots), dtype = np.int64)
+            ranks[np.argsort(self.root_priorities(roots, seed), kind = "stable")] = np.arange(len(roots))
+            kept = ranks < n
+            if on_chunk is not None and not self.has_full(params, seed):
+                with self.timer.stage("preview"):
+                    self.emit_preview(params, seed, ranks, max(1, int(n * PREVIEW_FRACTION)) if n > 0 else 0, on_chunk)
+        if params.seed is None:
+            verts, offsets = self.prefix_result(params, seed, kept, progress, on_chunk)
+        else:
+            verts, offsets = self.full_result(params, seed, progress, on_chunk, kept)
+        styled_edges = [np.arange(offsets[k], offsets[k + 1]) for k in range(n)]
+        self.timer.count("guides", len(self.e))
+        self.timer.count("roots", n)
+        self.timer.count("vertices", offsets[n])
+        if progress is not None:
+            progress(100)
+        self.timer.emit("progress", percent = 100)
+        return verts[:offsets[n]], styled_edges
+
+    def full_key(self, params: WispParams, seed: int) -> tuple:
+        return (params.length, params.curliness, seed, params.wisp_r, params.tl_rand, params.dropout, params.len_rand)
+
+    def has_full(self, params: WispParams, seed: int) -> bool:
+        return self.full is not None and self.full[0] == self.full_key(params, seed)
+
+    def full_result(self, params: WispParams, seed: int, progress = None, on_chunk = None, kept: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """ Every root's wisp at full density, as (verts, strand offsets) in priority order, cached for the latest parameters"""
+        # <on_chunk> gets the wisps of the roots flagged in <kept> (clumping order) every CHUNK_GUIDES guides
+        key = self.full_key(params, seed)
+        if self.full is not None and self.full[0] == key:
+            if on_chunk is not None:
+                n = int(np.sum(kept))
+                offsets = self.full[2]
+                on_chunk("chunk", self.full[1][:offsets[n]], np.diff(offsets[:n + 1]))
+            return self.full[1:]
+        guide_verts, guide_lens = self.guide_pass(lambda i: self.guide_wisps(i, params, seed), progress, on_chunk, kept)
+        # wisps come out guide by guide, in clumping order; gather them into priority order
+        with self.timer.stage("gather"):
+            priorities = self.root_priorities([root for roots in self.clumping_map for root in roots], seed)
+            self.full = (key, *priority_gather(guide_verts, guide_lens, priorities))
+        return self.full[1:]
+
+    def prefix_result(self, params: WispParams, seed: int, kept: np.ndarray, progress = None, on_chunk = None) -> tuple[np.ndarray, np.ndarray]:
+        """ Only the wisps of the roots flagged in <kept> (clumping order), as (verts, strand offsets) in priority order, uncached"""
+        marks = np.cumsum([0] + [len(roots) for roots in self.clumping_map])
+        built = []
+
+        def build(i):
+            roots = self.clumping_map[i]
+            subset = [roots[k] for k in np.flatnonzero(kept[marks[i]:marks[i + 1]])]
+            built.extend(subset)
+            if len(subset) == 0:
+                return np.empty((0, 3)), []
+            wisps = self.subset_wisps(i, subset, params, seed)
+            return np.concatenate(wisps), [len(w) for w in wisps]
+
+        guide_verts, guide_lens = self.guide_pass(build, progress, on_chunk)
+        with self.timer.stage("gather"):
+            return priority_gather(guide_verts, guide_lens, self.root_priorities(built, seed))
+
+    def guide_pass(self, build, progress = None, on_chunk = None, kept: np.ndarray = None) -> tuple[list[np.ndarray], list[int]]:
+        """ Calls build(i) -> (wisp verts, wisp lengths) for every guide, returns them all as (per-guide verts, every wisp length)"""
+        # progress is reported as the guides go; <on_chunk> gets the built wisps every CHUNK_GUIDES guides,
+        # only those flagged in <kept> (one flag per built wisp) if given
+        e = self.e
+        guide_verts = []
+        guide_lens = []
+        pending = [] # (verts, lens, kept) of guides not yet sent to <on_chunk>
+        percent_mark = 0
+        for i in range(len(e)):
+            percent = int((i/len(e))*100)
+            if percent >= percent_mark:
+                self.timer.emit("progress", percent = percent)
+                percent_mark += 10
+            if progress is not None:
+                progress(percent)
+            wisp_verts, wisp_lens = build(i)
+            guide_verts.append(wisp_verts)
+            guide_lens.extend(wisp_lens)
+            if on_chunk is not None:
+                flags = None if kept is None else kept[len(guide_lens) - len(wisp_lens):len(guide_lens)]
+                pending.append((wisp_verts, wisp_lens, flags))
+                if len(pending) >= CHUNK_GUIDES or i == len(e) - 1:
+                    emit_wisps("chunk", pending, on_chunk)
+                    pending = []
+        return guide_verts, guide_lens
+
+    def emit_preview(self, params: WispParams, seed: int, ranks: np.ndarray, count: int, on_chunk):
+        """ Sends the <count> highest priority wisps, decimated to every PREVIEW_STEP-th vertex, as one "preview" chunk"""
+        pending = []
+        root_mark = 0
+        for i, roots in enumerate(self.clumping_map):
+            picked = np.flatnonzero(ranks[root_mark:root_mark + len(roots)] < count)
+            root_mark += len(roots)
+            if len(picked) == 0:
+                continue
+            wisps = self.subset_wisps(i, [roots[k] for k in picked], params, seed)
+            coarse = [w[np.unique(np.append(np.arange(0, len(w), PREVIEW_STEP), len(w) - 1))] for w in wisps]
+            pending.append((np.concatenate(coarse), [len(w) for w in coarse], None))
+        emit_wisps("preview", pending, on_chunk)
+
+    def subset_wisps(self, i: int, roots: list[int], params: WispParams, seed: int) -> list[np.ndarray]:
+        """ The wisps of some of guide <i>'s roots, built through the same stages as guide_wisps but not cached"""
+        # the roots' own streams make each wisp the same one a full pass builds
+        strand, frames = self.stage("guide", i, (params.length, params.curliness), lambda: self.guide_strand(i, params))
+        guide_len = len(self.e[i])
+        with self.timer.stage("draws"):
+            draws = self.root_draws(roots, seed, guide_len)
+        with self.timer.stage("fft"):
+            displacements = self.batch_displacements(*draws[:3], params.curliness, guide_len)
+        with self.timer.stage("reroot"):
+            rerooted = self.reroot_wisps(roots, strand, frames, draws, displacements, params)
+        with self.timer.stage("resample"):
+            return self.resample_wisps(rerooted, params.len_rand, draws)
+
+    def root_priorities(self, roots: list[int], seed: int) -> np.ndarray:
+        """ A uniform draw per root from its own stream; lower draws are kept first as density drops"""
+        if self.priorities is None or self.priorities[0] != seed:
+            self.priorities = (seed, {})
+        cached = self.priorities[1]
+        for root in roots:
+            if root not in cached:
+                cached[root] = stream_rng(seed, PRIORITY_STREAM, root).random()
+        return np.array([cached[root] for root in roots])
+
+    def stage(self, name: str, i: int, key: tuple, compute):
+        """ Returns stage <name> of guide <i>, calling <compute> only when <key> differs from the cached one"""
+        cached = self.stages[name].get(i)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with self.timer.stage(STAGE_TIMERS[name]):
+            value = compute()
+        self.stages[name][i] = (key, value)
+        return value
+
+    def guide_wisps(self, i: int, params: WispParams, seed: int) -> tuple[np.ndarray, list[int]]:
+        """ Builds every wisp of guide <i> in a batch, returns the stacked verts and the length of each wisp"""
+        # the guide key feeds every stage from reroot on, so a curliness or length change costs about a cold pass
+        roots = self.clumping_map[i]
+        if len(roots) == 0:
+            return np.empty((0, 3)), []
+        guide_key = (params.length, params.curliness)
+        reroot_key = (guide_key, seed, params.wisp_r, params.tl_rand, params.dropout)
+        resample_key = (reroot_key, params.len_rand)
+
+        guide_len = len(self.e[i])
+        draws = lambda: self.stage("draws", i, (seed, guide_len), lambda: self.root_draws(roots, seed, guide_len))
+
+        def reroot():
+            strand, frames = self.stage("guide", i, guide_key, lambda: self.guide_strand(i, params))
+            buckets, amp_ids, ang_ids = draws()[:3]
+            displacements = self.stage("curl", i, (seed, params.curliness, guide_len), lambda: self.batch_displacements(buckets, amp_ids, ang_ids, params.curliness, guide_len))
+            return self.reroot_wisps(roots, strand, frames, draws(), displacements, params)
+
+        def resample():
+            rerooted = self.stage("reroot", i, reroot_key, reroot)
+            wisps = self.resample_wisps(rerooted, params.len_rand, draws())
+            return np.concatenate(wisps), [len(w) for w in wisps]
+
+        return self.stage("resample", i, resample_key, resample)
+
+    def resample_wisps(self, rerooted: list[np.ndarray], len_rand: tuple[float, float], draws: tuple) -> list[np.ndarray]:
+        """ Resamples each rerooted wisp evenly up to its randomized length"""
+        t_maxs = len_rand[0] + (len_rand[1] - len_rand[0])*draws[4][:, 1] #length randomization
+        # equal-length wisps are resampled together as one stack of curves
+        lengths = [len(w) for w in rerooted]
+        wisps = [None]*len(rerooted)
+        for rows in dft.length_groups(lengths):
+            resampled = splines.even_catmull(np.stack([rerooted[j] for j in rows]), lengths[rows[0]], t_maxs[rows])
+            for j, w in zip(rows, resampled):
+                wisps[j] = w
+        return wisps
+
+    def guide_strand(self, i: int, params: WispParams) -> tuple[np.ndarray, np.ndarray]:
+        """ Stage 1: guide <i> with the length and curliness adjustments applied, and its frames"""
+        strand = self.v[self.e[i]]
+
+        # Ajusta comprimento
+        if params.length != 1.0:
+            strand = strand * params.length
+
+        # Ajusta curliness com uma ondulação leve (senoide)
+        if params.curliness > 0.0:
+            offsets = np.sin(np.arange(len(strand)) * 0.5) * 0.002 * params.curliness
+            strand[:, 0] += offsets
+            strand[:, 2] += offsets
+        return strand, io.make_frames(strand, M1)
+
+    def root_draws(self, roots: list[int], seed: int, guide_len: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Stage 2: every random draw of each root, as (spectrum buckets, amps ids, angs ids, shifts, (tL, length) draws, dropout draws)"""
+        # each root draws from its own stream, in that order; the dropout draws cover the longest possible tail
+        n = len(roots)
+        picks = np.empty((n, 2))
+        shifts = np.empty((n, 2))
+        t_len = np.empty((n, 2))
+        drops = np.empty((n, guide_len))
+        for j, root in enumerate(roots):
+            rng = stream_rng(seed, ROOT_STREAM, root)
+            picks[j] = rng.random(2) #creating the random displacement at the loose portion
+            shifts[j] = rng.random(2)
+            t_len[j] = rng.random(2)
+            drops[j] = rng.random(guide_len)
+        return *self.spectra.sample(picks), shifts, t_len, drops
+
+    def batch_displacements(self, buckets: np.ndarray, amp_ids: np.ndarray, ang_ids: np.ndarray, curliness: float, guide_len: int) -> list[np.ndarray]:
+        """ Stage 3: the curliness-filtered inverse FFTs of the picked spectra, looked up in the library's displacement bank"""
+        #Aplicar filtro espectral com base no curliness
+        displacements = self.spectra.displacements(buckets, amp_ids, ang_ids, curliness)
+        if guide_len < 10: # displacement downscaling: doing smaller winds when the total strand length is low
+            displacements = [d*guide_len/10 for d in displacements]
+        return displacements
+
+    def reroot_wisps(self, roots: list[int], strand: np.ndarray, frames: np.ndarray, draws: tuple, displacements: list[np.ndarray], params: WispParams) -> list[np.ndarray]:
+        """ Stage 4: shifts the guide once per root and reroots each copy onto its scalp point"""
+        _, _, _, shifts, t_len, drops = draws
+        xs = 2*shifts[:, 0]-1
+        ys = 2*shifts[:, 1]-1
+        shifted = io.par_shift_batch(strand, frames, xs, ys, lambda t: io.grow_rate_map(t, params.wisp_r[0], params.wisp_r[1]))
+        centers = dft.get_centercurves(shifted)
+
+        t_ss = params.tl_rand[0] + (params.tl_rand[1] - params.tl_rand[0])*t_len[:, 0]
+        return rerooted_curl_batch(self.v_scalp[roots], params.dropout, t_ss, displacements, shifted, M1, centers, drops)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="adding detail to a sequence of guide obj strands")
 
@@ -175,8 +452,9 @@ if __name__ == "__main__":
     parser.add_argument("clumpingFile", help="The csv file that pairs the guide strands with their corresponding group of vertices in the scalp", type= str)
     parser.add_argument("outputObj", help="Full filepath to the output obj file", type = str)
 
-    parser.add_argument("--amps", help="The .npz that contains FFT information for amplitude spectra sampling", type = str, default ='../../data/amp_angle_stats/fullCombStats/fullComb.objAmps.npz')
-    parser.add_argument("--angs", help="The .npz that contains FFT information for phase spectra sampling", type = str, default ='../../data/amp_angle_stats/fullCombStats/fullComb.objAmps.npz')
+    parser.add_argument("--amps", help="The .npz that contains FFT information for amplitude spectra sampling", type = str, default = DEFAULT_AMPS)
+    parser.add_argument("--angs", help="The .npz that contains FFT information for phase spectra sampling", type = str, default = DEFAULT_ANGS)
+    parser.add_argument("--spectra", help="A packed spectra .npz from spectrum_exporter, used instead of --amps/--angs", type = str, default = None)
     parser.add_argument("--tlRand", help="Range for tL randomization (range 0-1)", type=float, nargs = 2, default = [0.1, 0.6])
     parser.add_argument("--lenRand", help="Range for strand length in wisp (range 0-1)", type=float, nargs = 2, default = [0.8,1])
     parser.add_argument("--wispR", help="Strictly-cohered wisp radius range", type=float, nargs=2, default=[0.07,0.35])
@@ -185,6 +463,7 @@ if __name__ == "__main__":
     parser.add_argument("--curliness", type=float, default=0.0, help="Curliness of the generated strands (0-1)")
     parser.add_argument("--length", type=float, default=1.0, help="Length multiplier for strands")
     parser.add_argument("--density", type=float, default=1.0, help="Density multiplier (fraction of strands to keep)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible output; each root keeps its wisp across runs")
 
     args = parser.parse_args()
     
@@ -194,77 +473,15 @@ if __name__ == "__main__":
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
-    #random.seed(1337)
-    #np.random.seed(1337)
-    amps_container = np.load(args.amps)
-    angs_container = np.load(args.angs)
-    amps_coll = [amps_container[k] for k in amps_container]
-    angs_coll = [angs_container[k] for k in angs_container]
-
-    # load strand(s)
-    v, e = io.read_obj_strands(args.inputObj)
-    # load scalp
-    scalp_file = args.scalpFile
-    v_scalp = io.vert_read(scalp_file)
-    # load clumping dictionary
-    clumping_name = args.clumpingFile
-    clumping_map = io.clumping_read(clumping_name)
-
-    m1 = np.array([-5, 5,0])
-    styled_verts = []
-    styled_edges = []
-    marker = 0
-    percent_mark = 0
-    for i in range(len(e)):
-
-    # for i in range(40,41):
-        percent = int((i/len(e))*100)
-        if percent >= percent_mark:
-            print(f'{datetime.datetime.now()}: reached {percent}%', flush=True)
-            percent_mark += 10
-        if args.density < 1.0 and random.random() > args.density:
-            continue
-        
-        strand = v[e[i]]
-
-        # Ajusta comprimento
-        if args.length != 1.0:
-            strand = [p * args.length for p in strand]
-
-        # Ajusta curliness com uma ondulação leve (senoide)
-        if args.curliness > 0.0:
-            for k, p in enumerate(strand):
-                offset = math.sin(k * 0.5) * 0.002 * args.curliness
-                p[0] += offset
-                p[2] += offset
-
-        for j in range(len(clumping_map[i])):
-            amps_rand = random.choice(amps_coll) #creating the random displacement at the loose portion
-            angs_rand = random.choice(angs_coll)
-            while len(amps_rand) != len(angs_rand):
-                amps_rand = random.choice(amps_coll)
-                angs_rand = random.choice(angs_coll)
-            freqs = amps_rand*(np.cos(angs_rand) + 1j*np.sin(angs_rand))
-            #displacements = np.fft.irfft(freqs, axis = 0, n = 2*len(amps_rand))
-
-            #Aplicar filtro espectral com base no curliness
-            keep_ratio = args.curliness
-            num_freqs = int(len(amps_rand) * keep_ratio)
-            freqs_filtered = np.zeros_like(freqs)
-            freqs_filtered[:num_freqs] = freqs[:num_freqs]
-
-            displacements = np.fft.irfft(freqs_filtered, axis=0, n=2*len(amps_rand))
-
-            shifted_strand = io.par_shift(strand, m1, 2*random.random()-1, 2*random.random()-1, lambda t: io.grow_rate_map(t, args.wispR[0], args.wispR[1]))
-            if (len(shifted_strand) < 10): # displacement downscaling: doing smaller winds when the total strand length is low
-                displacements = displacements*len(shifted_strand)/10
-            rerooted = rerooted_curl(v_scalp[clumping_map[i][j]], m1, args.dropout, args.tlRand[0] + (args.tlRand[1] - args.tlRand[0])*random.random(), displacements, shifted_strand, m1)
-            
-            rerooted = even_catmull(rerooted, len(rerooted), args.lenRand[0] + (args.lenRand[1] - args.lenRand[0])*random.random()) #length randomization
-            styled_verts.append(rerooted[:])
-            styled_edges.append(np.arange(marker, marker + len(rerooted)))
-            marker += len(rerooted)
-            # io.export_strand(rerooted, f"reroot_test{i}-{clumping_map[i][j]}.obj")
-    print(f"{datetime.datetime.now()}: finished!")
+    timer = stageTimer(print_event)
+    if args.spectra is not None:
+        engine = WispifyEngine(args.inputObj, args.scalpFile, args.clumpingFile, args.spectra, None, timer)
+    else:
+        engine = WispifyEngine(args.inputObj, args.scalpFile, args.clumpingFile, args.amps, args.angs, timer)
+    params = WispParams(curliness = args.curliness, length = args.length, density = args.density,
+                        tl_rand = tuple(args.tlRand), len_rand = tuple(args.lenRand), wisp_r = tuple(args.wispR), dropout = args.dropout, seed = args.seed)
+    styled_verts, styled_edges = engine.generate(params, timer = timer)
     print(f"writing to {args.outputObj}", flush=True)
-    io.export_obj(numpy_flat(styled_verts), styled_edges, args.outputObj)
+    with timer.stage("export"):
+        io.export_obj(styled_verts, styled_edges, args.outputObj)
+    timer.emit("summary", **timer.summary())
@@ -0,0 +1,105 @@
+# Stylizes a whole sequence of guide frames (e.g. the droop animation) into one animated strand cache
+# every frame shares the scalp, clumping, spectra and per-root random draws, so wisps stay coherent over time
+
+import numpy as np
+import sys
+import os
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(script_dir)
+
+from wispify import WispifyEngine, WispParams, DEFAULT_AMPS, DEFAULT_ANGS
+import file_io as io
+
+def frame_files(guide_dir: str) -> list[str]:
+    """ The .obj frames of <guide_dir>, in numeric order of their names where they are numbers"""
+    objs = glob.glob(os.path.join(guide_dir, "*.obj"))
+    stem = lambda path: os.path.splitext(os.path.basename(path))[0]
+    return sorted(objs, key = lambda path: (0, int(stem(path)), "") if stem(path).isdigit() else (1, 0, stem(path)))
+
+# per-process engine over the shared inputs, built once by the pool initializer
+_worker_engine = None
+
+def _init_sequence_worker(first_obj: str, scalp_file: str, clumping_file: str, amps_file: str, angs_file: str):
+    global _worker_engine
+    _worker_engine = WispifyEngine(first_obj, scalp_file, clumping_file, amps_file, angs_file)
+
+def _generate_frame(job: tuple[str, WispParams]) -> tuple[np.ndarray, np.ndarray]:
+    frame_obj, params = job
+    verts, edges = _worker_engine.for_guides(frame_obj).generate(params)
+    return verts.astype(np.float32), np.array([len(e) for e in edges], dtype = np.int64)
+
+def generate_sequence(frames: list[str], scalp_file: str, clumping_file: str, output_cache: str, params: WispParams,
+                      amps_file: str = DEFAULT_AMPS, angs_file: str = DEFAULT_ANGS, workers: int = 1):
+    """ Generates every frame with the same seeded draws and writes them as one animated cache (see file_io.animatedCacheWriter)"""
+    assert params.seed is not None, "a sequence needs a fixed seed to keep its wisps coherent"
+    jobs = [(frame, params) for frame in frames]
+    initargs = (frames[0], scalp_file, clumping_file, amps_file, angs_file)
+    writer = None
+    pool = ProcessPoolExecutor(max_workers = workers, initializer = _init_sequence_worker, initargs = initargs) if workers > 1 else None
+    try:
+        if pool is None:
+            _init_sequence_worker(*initargs)
+            results = map(_generate_frame, jobs)
+        else:
+            results = pool.map(_generate_frame, jobs)
+        for frame, (verts, lengths) in zip(frames, results):
+            if writer is None:
+                offsets = np.concatenate([[0], np.cumsum(lengths)])
+                writer = io.animatedCacheWriter(output_cache, np.arange(offsets[-1]), offsets, len(verts))
+            elif len(verts) != writer.n_verts or not np.array_equal(np.cumsum(lengths), offsets[1:]):
+                raise ValueError(f"{frame} doesn't share the topology of {frames[0]}; are the guides' vertex counts the same in every frame?")
+            writer.write_frame(verts)
+            print(f"wrote frame {writer.n_frames}/{len(frames)}: {frame}", flush = True)
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures = True)
+    writer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "adding detail to every frame of a guide obj sequence, written as one animated cache")
+
+    parser.add_argument("guideDir", help = "Directory holding the guide frames (0.obj, 1.obj, ...)", type = str)
+    parser.add_argument("scalpFile", help = "The obj file containing all the high-resolution strand roots; should correspond to pairing file", type = str)
+    parser.add_argument("clumpingFile", help = "The csv file that pairs the guide strands with their corresponding group of vertices in the scalp", type = str)
+    parser.add_argument("outputCache", help = f"Full filepath to the output animated cache (conventionally {io.ANIM_SUFFIX})", type = str)
+
+    parser.add_argument("--amps", help = "The .npz that contains FFT information for amplitude spectra sampling", type = str, default = DEFAULT_AMPS)
+    parser.add_argument("--angs", help = "The .npz that contains FFT information for phase spectra sampling", type = str, default = DEFAULT_ANGS)
+    parser.add_argument("--spectra", help = "A packed spectra .npz from spectrum_exporter, used instead of --amps/--angs", type = str, default = None)
+    parser.add_argument("--tlRand", help = "Range for tL randomization (range 0-1)", type = float, nargs = 2, default = [0.1, 0.6])
+    parser.add_argument("--lenRand", help = "Range for strand length in wisp (range 0-1)", type = float, nargs = 2, default = [0.8, 1])
+    parser.add_argument("--wispR", help = "Strictly-cohered wisp radius range", type = float, nargs = 2, default = [0.07, 0.35])
+    parser.add_argument("--dropout", help = "Probability of having a vertex drop out in strict area (range 0-1)", type = float, default = 0.5)
+
+    parser.add_argument("--curliness", type = float, default = 0.0, help = "Curliness of the generated strands (0-1)")
+    parser.add_argument("--length", type = float, default = 1.0, help = "Length multiplier for strands")
+    parser.add_argument("--density", type = float, default = 1.0, help = "Density multiplier (fraction of strands to keep)")
+    parser.add_argument("--seed", type = int, default = None, help = "Seed shared by every frame; a random one is picked (and printed) if not given")
+    parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "Processes to spread the frames over")
+
+    args = parser.parse_args()
+
+    print(sys.argv, flush = True)
+
+    frames = frame_files(args.guideDir)
+    if len(frames) == 0:
+        sys.exit(f"no .obj frames in {args.guideDir}")
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % 2**63)
+    print(f"{len(frames)} frames, seed {seed}", flush = True)
+
+    outputDir = os.path.split(args.outputCache)[0]
+    if outputDir and not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    params = WispParams(curliness = args.curliness, length = args.length, density = args.density,
+                        tl_rand = tuple(args.tlRand), len_rand = tuple(args.lenRand), wisp_r = tuple(args.wispR), dropout = args.dropout, seed = seed)
+    amps, angs = (args.spectra, None) if args.spectra is not None else (args.amps, args.angs)
+    generate_sequence(frames, args.scalpFile, args.clumpingFile, args.outputCache, params, amps, angs, args.workers)
@@ -2,13 +2,12 @@
 
 import sys
 import numpy as np
-import time as ti
 import random
 import math
 import csv
 import os
 import argparse
-import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 script_dir = os.path.dirname(__file__)
 mymodules_dir = os.path.join(script_dir, '..','..','src')
@@ -16,6 +15,7 @@ sys.path.append(mymodules_dir)
 
 import file_io as io
 import octrees_lite as oct
+from instrumentation import stageTimer, print_event
 
 def prob_func(r, r0, pf):
     if r <= r0:
@@ -39,73 +39,124 @@ def zone_selector(ps: np.ndarray[np.ndarray], ds: np.ndarray[float], ratio:float
         ind = -1
     return ps[ind]
 
+# zone_selector for every row of (inds, ds) at once
+def zone_select_batch(inds: np.ndarray, ds: np.ndarray, ratio: float, selection_method = 0) -> np.ndarray:
+    if inds.shape[1] == 1:
+        return inds[:, 0]
+    rows = np.arange(len(inds))
+    if selection_method == 0: # inverse probability function
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            inv_ds = 1/ds
+            cdf = np.cumsum(inv_ds, axis = 1) / np.sum(inv_ds, axis = 1, keepdims = True)
+        picks = np.sum(cdf < np.random.random((len(inds), 1)), axis = 1)
+        picks = np.where(np.isfinite(cdf[:, -1]), np.minimum(picks, inds.shape[1] - 1), 0) # a zero distance just takes the closest
+    elif selection_method == 1: # uniform choice
+        picks = np.random.randint(0, inds.shape[1], size = len(inds))
+    else:
+        picks = np.full(len(inds), inds.shape[1] - 1)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        keep_closest = ds[:, 0]/ds[:, 1] < ratio
+    picks[keep_closest] = 0
+    return inds[rows, picks]
+
+# per-process guide grid for pooled queries, built once by the pool initializer
+_worker_grid = None
+
+def _init_query_worker(guide_roots: np.ndarray):
+    global _worker_grid
+    _worker_grid = oct.pointGrid(guide_roots)
+
+def _query_chunk(job: tuple[np.ndarray, int]) -> tuple[np.ndarray, np.ndarray]:
+    roots, k = job
+    return _worker_grid.query(roots, k)
+
+# k nearest guides (indices, square distances) for every full-res root, optionally fanned out over a process pool
+def query_guides(full_roots: np.ndarray, guide_roots: np.ndarray, k: int, workers: int = 1, chunk: int = 8192) -> tuple[np.ndarray, np.ndarray]:
+    if workers <= 1 or len(full_roots) <= chunk:
+        return oct.pointGrid(guide_roots).query(full_roots, k)
+    jobs = [(full_roots[c:c + chunk], k) for c in range(0, len(full_roots), chunk)]
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_query_worker, initargs = (guide_roots,)) as pool:
+        results = list(pool.map(_query_chunk, jobs))
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+# turns one shared neighbor query into a guide_to_roots grouping per pullR
+def groupings_from_neighbors(inds: np.ndarray, ds: np.ndarray, n_guides: int, pull_rs: list[int]) -> dict[int, list[list[int]]]:
+    groupings = {}
+    for pull_r in pull_rs:
+        # some fuzzing depending on distance to center
+        closest_guide = zone_select_batch(inds[:, :pull_r], ds[:, :pull_r], -1.0, selection_method=1)
+        guide_to_roots = [[] for _ in range(n_guides)]
+        for i, g in enumerate(closest_guide.tolist()):
+            guide_to_roots[g].append(i)
+        groupings[pull_r] = guide_to_roots
+    return groupings
+
+def grouping_file_name(scalp_roots_obj: str, scalp_guides_obj: str, name_suffix: str) -> str:
+    return os.path.split(scalp_guides_obj)[1].split(".")[0]+"-"+os.path.split(scalp_roots_obj)[1].split(".")[0]+"-groupings" + name_suffix + ".csv"
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("scalpRootsObj", type = str, help = "The full-resolution scalp points")
     parser.add_argument("scalpGuidesObj", type = str, help = "The guide points")
     parser.add_argument("--fout", type = str, help = "The file to output the clumping", default = "./")
     parser.add_argument("--pullR", type = int, help = "The number of nth-ranked distances to find and randomly assign", default = 30)
+    parser.add_argument("--pullRs", type = int, nargs = "+", help = "Several pullR values from one neighbor query; writes one csv per value, suffixed r<pullR>", default = None)
+    parser.add_argument("--workers", type = int, help = "Processes to spread the root queries over (grid only)", default = 1)
     parser.add_argument("--nameSuffix", type = str, help = "Adding an identifying string for wedging", default = "")
+    parser.add_argument("--spatialIndex", type = str, choices = ["grid", "octree"], help = "Flat guide grid (exact, batched) or the legacy octree", default = "grid")
     parser.add_argument("--recursionLimit", type = int, help = "Recursion limit for the octree stuff", default = 32000)
     parser.add_argument("--smallestNode", type = int, help = "Smallest node for the octree stuff", default = 2)
 
     args = parser.parse_args()
 
     print(sys.argv, flush=True)
-    sys.setrecursionlimit(args.recursionLimit)
+
+    timer = stageTimer(print_event)
 
     # reading in the point clouds
-    full_roots = io.vert_read(args.scalpRootsObj)
-    guide_roots = io.vert_read(args.scalpGuidesObj)
-    # v_scalp, f_scalp = igl.read_triangle_mesh(args[2])
-    guide_roots_dict = {}
-    for i, p in enumerate(guide_roots):
-        p_key = str(p)
-        guide_roots_dict.update({p_key : int(i)})
+    with timer.stage("load"):
+        full_roots = io.vert_read(args.scalpRootsObj)
+        guide_roots = io.vert_read(args.scalpGuidesObj)
 
     print(f"len(full_roots): {len(full_roots)}")
     print(f"len(guide_roots): {len(guide_roots)}")
-    print(f"guide roots dict: {len(guide_roots_dict)}")
-    print("making octree...")
-    u = np.max(guide_roots, axis = 0)
-    d = np.min(guide_roots, axis = 0)
-    tree_start = ti.time()
-    oct_root = oct.make_octree(guide_roots, args.smallestNode, u, d)
-    print(f"octree done in {ti.time() - tree_start} seconds!")
-    diam = oct.average_leaf_diam(oct_root)
-    print(f"octree average leaf diameter: {diam}")
+    if args.spatialIndex == "octree":
+        sys.setrecursionlimit(args.recursionLimit)
+        print("making octree...")
+        with timer.stage("index"):
+            oct_root = oct.make_octree(guide_roots, args.smallestNode, np.max(guide_roots, axis = 0), np.min(guide_roots, axis = 0))
+            diam = oct.average_leaf_diam(oct_root)
+        print(f"octree average leaf diameter: {diam}")
+    else:
+        print("querying through the guide grid...")
 
     # # make an array that matches each index of the full root to its corresponding index into guide_roots
     # and also an array that matches each guide index to a list of all the root indices
-    closest_guide = np.zeros(len(full_roots))
-    guide_to_roots = [[] for _ in range(len(guide_roots))]
-    print("timing closest_guide and guide_to_roots creation")
-    creation_start = ti.time()
-    percent = 0
-    for i, v in enumerate(full_roots):
-        cur_percent = int((i/len(full_roots))*100)
-        if cur_percent >= percent:
-            print(f'{datetime.datetime.now()}: reached {percent}%', flush=True)
-            percent += 10
-        ps, ds = oct.closest_guide_inds(v, oct_root, diam/2.0, 2*args.pullR)
-        # print(ds)
-        # some fuzzing depending on distance to center
-        selected_p = zone_selector(ps[:args.pullR], ds[:args.pullR], -1.0, selection_method=1)
-        closest_guide[i] = int(guide_roots_dict[str(selected_p)])
-        guide_to_roots[int(closest_guide[i])].append(i)
+    pull_rs = args.pullRs if args.pullRs is not None else [args.pullR]
+    k = 2*max(pull_rs) # the neighbor set for the largest pullR serves every smaller one
+    with timer.stage("query"):
+        if args.spatialIndex == "octree": # the octree hands back guide indices too, one root at a time
+            k = min(k, len(guide_roots))
+            inds = np.empty((len(full_roots), k), dtype = np.int64)
+            ds = np.empty((len(full_roots), k))
+            for i, v in enumerate(full_roots):
+                inds[i], ds[i] = oct.closest_guide_inds(v, oct_root, diam/2.0, k)
+        else:
+            inds, ds = query_guides(full_roots, guide_roots, k, args.workers)
+    with timer.stage("group"):
+        groupings = groupings_from_neighbors(inds, ds, len(guide_roots), pull_rs)
+    timer.count("roots", len(full_roots))
+    timer.count("guides", len(guide_roots))
 
-    print(f"array creation took {ti.time() - creation_start} seconds.")
-
-    # file_name = args[0].split(".")[0]+"-"+args[1].split(".")[0]+"-prox_dict.txt"
-    file_name2 = os.path.split(args.scalpGuidesObj)[1].split(".")[0]+"-"+os.path.split(args.scalpRootsObj)[1].split(".")[0]+"-groupings" + args.nameSuffix + ".csv"
-    file_name2 = os.path.join(args.fout, file_name2)
     if not os.path.exists(args.fout):
         os.makedirs(args.fout)
-    # print(f"saving to {file_name}")
-    # np.savetxt(file_name, closest_guide)
-    print(f"saving to {file_name2}") 
-    with open(file_name2, "w", newline="") as f:
-        wr = csv.writer(f, delimiter=",")
-        wr.writerows(guide_to_roots)
-
-    exit(0)
\ No newline at end of file
+    for pull_r, guide_to_roots in groupings.items():
+        name_suffix = args.nameSuffix if args.pullRs is None else f"{args.nameSuffix}r{pull_r}"
+        file_name2 = os.path.join(args.fout, grouping_file_name(args.scalpRootsObj, args.scalpGuidesObj, name_suffix))
+        print(f"saving to {file_name2}")
+        with timer.stage("export"), open(file_name2, "w", newline="") as f:
+            wr = csv.writer(f, delimiter=",")
+            wr.writerows(guide_to_roots)
+    timer.emit("summary", **timer.summary())
+
+    exit(0)
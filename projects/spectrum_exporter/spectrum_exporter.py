@@ -5,6 +5,7 @@ import numpy as np
 import sys
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 script_dir = os.path.dirname(__file__)
 mymodules_dir = os.path.join(script_dir, '..','..','src')
@@ -12,21 +13,56 @@ sys.path.append(mymodules_dir)
 
 import file_io as io
 import dft_testing as dft
+import spectrum_library as spec
+
+# strands of equal length, in chunks of at most <chunk>, as (strand ids, (n, length, 3) stack) jobs
+def length_chunks(verts: np.ndarray, indices: np.ndarray, offsets: np.ndarray, chunk: int) -> list[tuple[np.ndarray, np.ndarray]]:
+    lengths = np.diff(offsets)
+    jobs = []
+    for l in np.unique(lengths):
+        ids = np.flatnonzero(lengths == l)
+        for c in range(0, len(ids), chunk):
+            rows = ids[c:c + chunk]
+            jobs.append((rows, verts[indices[offsets[rows, None] + np.arange(l)]]))
+    return jobs
+
+# amplitude and angle spectra of every strand, computed over length-stacked chunks on <workers> processes
+def collect_spectra(verts: np.ndarray, indices: np.ndarray, offsets: np.ndarray, workers: int = 1, chunk: int = 4096) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    jobs = length_chunks(verts, indices, offsets, chunk)
+    if workers <= 1 or len(jobs) == 1:
+        results = [dft.fft_amp_angle_collect_batch(strands) for _, strands in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(dft.fft_amp_angle_collect_batch, [strands for _, strands in jobs]))
+    amps = [None]*(len(offsets) - 1)
+    angs = [None]*(len(offsets) - 1)
+    for (rows, _), (chunk_amps, chunk_angs) in zip(jobs, results):
+        for r, a, g in zip(rows, chunk_amps, chunk_angs):
+            amps[r] = a
+            angs[r] = g
+    return amps, angs
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Generating spectra for later usage in stylization")
     parser.add_argument("fullRezObj", help = "The full resolution strand set that takes all of the amplitude/angle info", type = str)
     parser.add_argument("outputDir", help = "Directory to put the output angles and amplitudes .npz files")
+    parser.add_argument("--workers", help = "Processes to spread the length-stacked FFTs over", type = int, default = os.cpu_count())
+    parser.add_argument("--chunk", help = "Most strands per stacked FFT job", type = int, default = 4096)
+    parser.add_argument("--packedOnly", help = "Skip the one-entry-per-strand Amps/Angs .npz pair (wispify's and the API's default spectra)", action = "store_true")
 
     args = parser.parse_args()
     print(sys.argv, flush = True)
 
-    verts, edges = io.read_obj_strands(args.fullRezObj)
-    amps, angs = dft.fft_amp_angle_collect(verts, edges)
+    verts, indices, offsets = io.read_obj(args.fullRezObj)
+    amps, angs = collect_spectra(verts, indices, offsets, args.workers, args.chunk)
 
     if not os.path.exists(args.outputDir):
         os.makedirs(args.outputDir)
 
     fullRezTail = os.path.split(args.fullRezObj)[1]
-    np.savez(os.path.join(args.outputDir, f'{fullRezTail}Amps'), *amps)
-    np.savez(os.path.join(args.outputDir, f'{fullRezTail}Angs'), *angs)
\ No newline at end of file
+    # one stack per spectrum length, strand order kept inside each; wispify reads it with --spectra
+    spec.spectrumLibrary.from_spectra(amps, angs).write_packed(os.path.join(args.outputDir, f'{fullRezTail}Spectra'))
+    # the pair is what DEFAULT_AMPS/DEFAULT_ANGS (and so the API) read, so a plain rerun keeps them current
+    if not args.packedOnly:
+        np.savez(os.path.join(args.outputDir, f'{fullRezTail}Amps'), *amps)
+        np.savez(os.path.join(args.outputDir, f'{fullRezTail}Angs'), *angs)
@@ -31,6 +31,20 @@ def get_centercurve(strand: np.ndarray):
     centered = centered + center_shift #center-shift finding (derived from optimizing point-wise distance sum)
     return centered
 
+def get_centercurves(strands: np.ndarray) -> np.ndarray:
+    """ get_centercurve over a stack of equal-length strands shaped (n, len, dim)"""
+    ds = np.diff(strands, axis = 1)
+    freqs = int(np.floor(ds.shape[1]/2) + 1)
+    trunc_f = max(min(freqs - 3,3), 1)
+    freq = np.fft.rfft(ds, axis = 1)
+    freq[:, trunc_f:] = 0
+    ds_trunc = np.fft.irfft(freq, axis = 1, n = ds.shape[1])
+    centered = np.empty(strands.shape)
+    centered[:, 0] = strands[:, 0]
+    centered[:, 1:] = strands[:, :1] + np.cumsum(ds_trunc, axis = 1)
+    center_shift = np.sum(strands - centered, axis = 1)/strands.shape[1]
+    return centered + center_shift[:, None]
+
 # does rfft to freq vector according to axis, then truncates amt of slow frequencies to 0
 # then does inverse rfft
 def hi_pass(arr: np.ndarray, amt: int, axis = 0) -> np.ndarray:
@@ -49,77 +63,135 @@ def fft_interpolate(arr0: np.ndarray, arr1: np.ndarray, t = 0.5, axis = 0) -> np
     freq = (1-t) * freq0 + t * freq1
     return np.fft.irfft(freq, axis = axis, n = len(arr0))
 
+class welfordStats:
+    """ Running mean and (population) variance of same-shaped samples, folded in one stacked batch at a time"""
+    # batches are merged with Chan et al.'s pairwise update, so memory stays at one sample's shape
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, batch: np.ndarray):
+        """ Folds in a (k, ...) stack of samples"""
+        if len(batch) == 0:
+            return
+        batch_mean = np.mean(batch, axis = 0)
+        batch_m2 = np.sum(np.abs(batch - batch_mean)**2, axis = 0)
+        self.merge(len(batch), batch_mean, batch_m2)
+
+    def merge(self, k: int, mean: np.ndarray, m2: np.ndarray):
+        """ Folds in the stats (count, mean, sum of squared deviations) of another set of samples"""
+        if self.n == 0:
+            self.n, self.mean, self.m2 = k, mean, m2
+            return
+        n = self.n + k
+        delta = mean - self.mean
+        self.mean = self.mean + delta*(k/n)
+        self.m2 = self.m2 + m2 + np.abs(delta)**2*(self.n*k/n)
+        self.n = n
+
+    def stats(self) -> tuple[np.ndarray, np.ndarray]:
+        """ (mean, standard deviation), as np.average and np.std over every sample would give"""
+        return self.mean, np.sqrt(self.m2/self.n)
+
+def length_groups(lengths: list[int]) -> list[np.ndarray]:
+    """ Indices of the entries of each distinct length, shortest length first"""
+    lengths = np.asarray(lengths)
+    return [np.flatnonzero(lengths == l) for l in np.unique(lengths)]
+
+def strand_batches(verts: np.ndarray[np.ndarray], edges: list[list[int]], chunk: int = 4096):
+    """ Yields the strands as (k, len, 3) stacks of equal-length strands, at most <chunk> at a time"""
+    for rows in length_groups([len(e) for e in edges]):
+        for c in range(0, len(rows), chunk):
+            yield verts[np.array([edges[i] for i in rows[c:c + chunk]])]
+
+def pad_rows(batch: np.ndarray, max_len: int) -> np.ndarray:
+    """ Zero-pads a (k, len, dim) stack along its second axis up to <max_len>"""
+    return np.pad(batch, ((0, 0), (0, max_len - batch.shape[1]), (0, 0)), mode = 'constant')
+
+def interp_rows(x: np.ndarray, xp: np.ndarray, fps: np.ndarray) -> np.ndarray:
+    """ np.interp(x, xp, fp) for every fp = fps[i, :, d] of a (k, len(xp), dim) stack at once"""
+    # same formula and edge handling as np.interp, with the bracketing computed once for the whole stack
+    j = np.clip(np.searchsorted(xp, x, side = "right") - 1, 0, len(xp) - 1)
+    j1 = np.minimum(j + 1, len(xp) - 1)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        slope = (fps[:, j1] - fps[:, j]) / (xp[j1] - xp[j])[:, None]
+        out = slope*(x - xp[j])[:, None] + fps[:, j]
+    exact = (x == xp[j]) | (x >= xp[-1]) # on a sample (or past the end) it is just that sample
+    out[:, exact] = fps[:, j[exact]]
+    out[:, x < xp[0]] = fps[:, :1]
+    return out
+
 # gets list of arrays, averages over each array element
 # also gets std div
 # theoretically a bit odd for shorter strands eh
 def padding_stats(arrs: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
     """ A helper for fft_stats to get avg and std_div of formatted data"""
-    max_len = 0
-    for a in arrs:
-        cand_len = len(a)
-        if cand_len > max_len:
-            max_len = cand_len
-    padded_data = np.zeros((len(arrs), max_len,arrs[0].shape[-1]),dtype=np.complex128)
-    for i in range(0, len(padded_data)):
-        padded_data[i] = np.pad(arrs[i],((0,max_len-len(arrs[i])),(0,0)), mode = 'constant')
-    avg = np.average(padded_data, axis = 0)
-    div = np.std(padded_data, axis = 0)
-    return avg, div
+    # zero-padded to the longest array, accumulated one length at a time
+    max_len = max(len(a) for a in arrs)
+    acc = welfordStats()
+    for rows in length_groups([len(a) for a in arrs]):
+        acc.add(pad_rows(np.stack([arrs[i] for i in rows]).astype(np.complex128), max_len))
+    return acc.stats()
 
 # does fft stat-finding given a vert and edge array from an obj
 # first stat: average, second stat: standard deviation
 def fft_stats(verts: np.ndarray[np.ndarray], edges: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
     """ Obtains basic fft average and std_div from set of strands (NOT CENTRAL DISPLACEMENT VERSION)"""
-    all_freqs = []
-    for st in edges:
-        cos = verts[st]
-        ds = io.verts_to_displacements(cos)
-        freq = np.fft.rfft(ds, axis=0)
-        all_freqs.append(freq[:])
-    return padding_stats(all_freqs)
+    max_len = (max(len(e) for e in edges) - 1)//2 + 1 # rfft length of the longest strand's displacements
+    acc = welfordStats()
+    for strands in strand_batches(verts, edges):
+        freq = np.fft.rfft(np.diff(strands, axis = 1), axis = 1)
+        acc.add(pad_rows(freq, max_len))
+    return acc.stats()
 
 def get_central_displacements(verts: np.ndarray[np.ndarray], mode: int = 2) -> np.ndarray[np.ndarray]:
     """ Obtains central displacements from strand defined by <verts> in order"""
-    if mode == 2: #2D projection option
-        disps = np.empty((len(verts), 2))
-    else: #3D projection option
-        disps = np.empty((len(verts), 3))
     centrals = get_centercurve(verts)
     offs = verts - centrals
     frames = io.make_frames(centrals, verts[0] - centrals[0])
-    if mode == 2:
-        for i in range(len(disps)):
-            disps[i][0] = np.dot(offs[i],frames[i][0])
-            disps[i][1] = np.dot(offs[i],frames[i][1])
-    else: 
-        for i in range(len(disps)):
-            disps[i][0] = np.dot(offs[i],frames[i][0])
-            disps[i][1] = np.dot(offs[i],frames[i][1])
-            disps[i][2] = np.dot(offs[i],frames[i][2])
-    return disps
+    # 2D projection keeps the (u, v) components, 3D projection also keeps the tangent component
+    return np.matmul(offs[:, None, None, :], frames[:, :mode, :, None])[..., 0, 0]
 
 def wind_displacements(centers: np.ndarray[np.ndarray], ds: np.ndarray[np.ndarray], up: np.ndarray, mode: int = 2) -> np.ndarray[np.ndarray]:
     """ Winds central displacements around center strand"""
-    winded = np.empty(centers.shape)
     frames = io.make_frames(centers, up)
     assert len(centers) <= len(ds), f"len(centers): {len(centers)} | len(ds): {len(ds)}"
-    if mode == 2:
-        for i in range(len(winded)):
-            winded[i] = centers[i] + frames[i][0]*ds[i][0] + frames[i][1]*ds[i][1]
-    else:
-        for i in range(len(winded)):
-            winded[i] = centers[i] + frames[i][0]*ds[i][0] + frames[i][1]*ds[i][1] + frames[i][2]*ds[i][2]
+    n = len(centers)
+    winded = centers + frames[:, 0]*ds[:n, 0:1] + frames[:, 1]*ds[:n, 1:2]
+    if mode != 2:
+        winded = winded + frames[:, 2]*ds[:n, 2:3]
+    return winded
+
+def get_central_displacements_batch(strands: np.ndarray, lengths: np.ndarray, mode: int = 2) -> np.ndarray:
+    """ get_central_displacements over a padded (n, max_len, 3) batch; padded entries come back as zero"""
+    lengths = np.asarray(lengths)
+    centrals = np.zeros(strands.shape)
+    for l in np.unique(lengths): # the centercurve FFT size depends on length, so go one length at a time
+        rows = np.nonzero(lengths == l)[0]
+        centrals[rows, :l] = get_centercurves(strands[rows, :l])
+    offs = strands - centrals
+    frames = io.make_frames_batch(centrals, strands[:, 0] - centrals[:, 0], lengths)
+    return np.matmul(offs[:, :, None, None, :], frames[:, :, :mode, :, None])[..., 0, 0]
+
+def wind_displacements_batch(centers: np.ndarray, ds: np.ndarray, up: np.ndarray, lengths: np.ndarray, mode: int = 2) -> np.ndarray:
+    """ wind_displacements over padded (n, max_len, 3) centers with matching padded displacements; padded entries are left as centers"""
+    frames = io.make_frames_batch(centers, up, lengths)
+    assert np.all(np.asarray(lengths) <= ds.shape[1]), f"max length: {np.max(lengths)} | ds.shape[1]: {ds.shape[1]}"
+    n = centers.shape[1]
+    winded = centers + frames[:, :, 0]*ds[:, :n, 0:1] + frames[:, :, 1]*ds[:, :n, 1:2]
+    if mode != 2:
+        winded = winded + frames[:, :, 2]*ds[:, :n, 2:3]
     return winded
 
 def fft_central_stats(verts: np.ndarray[np.ndarray], edges: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
     """ Obtains average and std_div of central displacement spectra"""
-    all_freqs = []
-    for st in edges:
-        cos = verts[st]
-        ds = get_central_displacements(cos)
-        freq = np.fft.rfft(ds, axis = 0)
-        all_freqs.append(freq[:])
-    return padding_stats(all_freqs)
+    max_len = max(len(e) for e in edges)//2 + 1
+    acc = welfordStats()
+    for strands in strand_batches(verts, edges):
+        ds = get_central_displacements_batch(strands, np.full(len(strands), strands.shape[1]))
+        acc.add(pad_rows(np.fft.rfft(ds, axis = 1), max_len))
+    return acc.stats()
 
 def spec_add(a: np.ndarray[np.ndarray], b: np.ndarray[np.ndarray], fa: np.ndarray, fb: np.ndarray) -> np.ndarray[np.ndarray]:
     """ Helper for adding two spectra that have slightly different resolutions"""
@@ -131,51 +203,46 @@ def spec_add(a: np.ndarray[np.ndarray], b: np.ndarray[np.ndarray], fa: np.ndarra
         r_val[min_ind] += b[i] 
     return r_val
 
+def spec_groups(spec_collection: list[np.ndarray]) -> list[np.ndarray]:
+    """ Indices of the entries sharing each distinct frequency grid"""
+    groups = {}
+    for i, spec in enumerate(spec_collection):
+        groups.setdefault((len(spec), spec.tobytes()), []).append(i)
+    return [np.array(rows) for rows in groups.values()]
+
 def resampled_stats(a: list[np.ndarray], spec_target: np.ndarray, spec_collection: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
     """ Helper for obtaining mean and std_div of frequency spectra"""
-    max_len = len(spec_target)
-    dim = a[0].shape[-1]
-    resampled_collection = np.empty((len(a), max_len, dim))
-    for i in range(len(resampled_collection)):
-        for d in range(dim):
-            resampled_collection[i][:,d] = np.interp(spec_target, spec_collection[i], a[i][:,d])
-    mean = np.average(resampled_collection, axis = 0)
-    div = np.std(resampled_collection, axis = 0)
-    return mean, div
+    acc = welfordStats()
+    for rows in spec_groups(spec_collection):
+        acc.add(interp_rows(spec_target, spec_collection[rows[0]], np.stack([a[i] for i in rows])))
+    return acc.stats()
 
 def resampled_sum(a: list[np.ndarray], spec_target: np.ndarray, spec_collection: list[np.ndarray]) -> np.ndarray:
     """ Helper for adding different-resolution frequency spectra"""
-    max_len = np.max([len(f) for f in a])
-    dim = a[0].shape[-1]
-    resampled_collection = np.empty((len(a), max_len, dim))
-    for i in range(len(resampled_collection)):
-        for d in range(dim):
-            resampled_collection[i][:,d] = np.interp(spec_target, spec_collection[i], a[i][:,d])
-    sum = np.sum(resampled_collection, axis = 0)
-    return sum
-        
+    total = np.zeros((len(spec_target), a[0].shape[-1]))
+    for rows in spec_groups(spec_collection):
+        total = total + np.sum(interp_rows(spec_target, spec_collection[rows[0]], np.stack([a[i] for i in rows])), axis = 0)
+    return total
+
 def fft_amp_angle_stats(verts: np.ndarray[np.ndarray], edges: list[list[int]]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """ Given a big set of strands, obtains averaged amplitude and frequency spectra of central displacements"""
-    amp_collection = []
-    re_collection = []
-    im_collection = []
-    spec_collection = []
-    for e in edges:
-        strand = verts[e]
-        ds = get_central_displacements(strand)
-        freq = np.fft.rfft(ds, axis = 0)
+    # streamed one length-stacked batch at a time, so memory holds one batch plus the running stats
+    spec_target = np.fft.rfftfreq(max(len(e) for e in edges))
+    amp_acc, re_acc, im_acc = welfordStats(), welfordStats(), welfordStats()
+    for strands in strand_batches(verts, edges):
+        ds = get_central_displacements_batch(strands, np.full(len(strands), strands.shape[1]))
+        freq = np.fft.rfft(ds, axis = 1)
         freq_a = np.abs(freq)
-        freq_re = np.real(freq)/freq_a
-        freq_im = np.imag(freq)/freq_a
-
-        spec_collection.append(np.fft.rfftfreq(len(ds)))
-        amp_collection.append(freq_a[:])
-        re_collection.append(freq_re[:])
-        im_collection.append(freq_im[:])
-    spec_target = np.fft.rfftfreq(np.max([len(e) for e in edges]))
-    amp_avg, amp_sig = resampled_stats(amp_collection, spec_target, spec_collection)
-    re_mean, re_sig = resampled_stats(re_collection, spec_target, spec_collection)
-    im_mean, im_sig = resampled_stats(im_collection, spec_target, spec_collection)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            freq_re = np.real(freq)/freq_a
+            freq_im = np.imag(freq)/freq_a
+        spec = np.fft.rfftfreq(strands.shape[1])
+        amp_acc.add(interp_rows(spec_target, spec, freq_a))
+        re_acc.add(interp_rows(spec_target, spec, freq_re))
+        im_acc.add(interp_rows(spec_target, spec, freq_im))
+    amp_avg, amp_sig = amp_acc.stats()
+    re_mean, re_sig = re_acc.stats()
+    im_mean, im_sig = im_acc.stats()
     ang_avg = np.arctan2(im_mean, re_mean)
     ang_sig = np.arctan2(im_sig, re_sig)
     return amp_avg, amp_sig, ang_avg, ang_sig
@@ -197,6 +264,16 @@ def fft_amp_angle_collect(verts: np.ndarray[np.ndarray], edges: list[list[int]])
         angle_collection.append(strand_angs[:])
     return amp_collection, angle_collection
 
+def fft_amp_angle_collect_batch(strands: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ fft_amp_angle_collect over a stack of equal-length strands (n, len, 3), returning stacked (n, len//2 + 1, 2) spectra"""
+    ds = get_central_displacements_batch(strands, np.full(len(strands), strands.shape[1]))
+    freq = np.fft.rfft(ds, axis = 1)
+    freq_a = np.abs(freq)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        freq_re = np.real(freq)/freq_a
+        freq_im = np.imag(freq)/freq_a
+    return freq_a, np.arctan2(freq_im, freq_re)
+
 def polar_to_complex(norm_arr: np.ndarray[np.ndarray], arg_arr: np.ndarray[np.ndarray]) -> np.ndarray[np.ndarray]:
     """ Helper for converting between polar coordinates and complex coordinates"""
     return norm_arr*(np.cos(arg_arr) + 1j* np.sin(arg_arr))
\ No newline at end of file
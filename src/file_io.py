@@ -2,100 +2,227 @@
 
 import numpy as np
 import csv
+import os
 
-def vert_read(filename: str) -> np.ndarray:
-    """ Reads only vertices from an .obj and stores in an np.array"""
-    total_verts = 0
+# binary strand cache: a 64 byte header, then the verts, flat line indices and strand offsets, each 8-byte aligned
+CACHE_SUFFIX = ".ccache"
+_CACHE_MAGIC = b"CCSTRND1"
+_CACHE_HEADER_BYTES = 64
+
+# animated strand cache: the same 64 byte header layout, the shared int32 CSR strands once, then one float32 (n_verts, 3) block per frame
+ANIM_SUFFIX = ".canim"
+_ANIM_MAGIC = b"CCANIM01"
+
+def parse_obj_text(text: str, read_lines: bool = True) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Single pass over .obj text: returns verts, flat 0-based "l" indices and CSR offsets into them"""
+    # strand k is indices[offsets[k]:offsets[k+1]]; the v block is tokenized in one go instead of line by line
+    v_rows = []
+    l_tokens = []
+    counts = []
+    for line in text.splitlines():
+        head = line[:2]
+        if head == "v " or head == "v\t":
+            v_rows.append(line[2:])
+        elif read_lines and (head == "l " or head == "l\t"):
+            tokens = line[2:].split()
+            l_tokens.extend(tokens)
+            counts.append(len(tokens))
+    v_tokens = " ".join(v_rows).split()
+    if len(v_tokens) != 3*len(v_rows):
+        # some rows carry extra components (e.g. "v x y z r g b" vertex colors): keep xyz, as iter_obj_strands does
+        v_tokens = []
+        for row in v_rows:
+            xyz = row.split()[:3]
+            if len(xyz) < 3:
+                raise ValueError(f"vertex line with fewer than 3 coordinates: 'v {row}'")
+            v_tokens.extend(xyz)
+    verts = np.array(v_tokens, dtype = float).reshape(-1, 3)
+    indices = np.array(l_tokens, dtype = np.int64) - 1 # obj's edges index into verts starting at 1
+    offsets = np.zeros(len(counts) + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
+    return verts, indices, offsets
+
+def _aligned(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+def write_strand_cache(path: str, verts: np.ndarray, indices: np.ndarray, offsets: np.ndarray, source_key: tuple[int, int] = (0, 0), vert_dtype = np.float64):
+    """ Writes verts (float32 or float64) and int32 CSR strands into the binary strand cache format"""
+    vert_dtype = np.dtype(vert_dtype)
+    assert len(verts) < 2**31 and len(indices) < 2**31, "strand cache stores int32 indices"
+    header = np.array([source_key[0], source_key[1], len(verts), len(indices), len(offsets), vert_dtype.itemsize], dtype = np.int64)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_CACHE_MAGIC + header.tobytes())
+        f.write(bytes(_CACHE_HEADER_BYTES - f.tell()))
+        for arr in (np.ascontiguousarray(verts, dtype = vert_dtype), np.ascontiguousarray(indices, dtype = np.int32), np.ascontiguousarray(offsets, dtype = np.int32)):
+            f.write(arr.tobytes())
+            f.write(bytes(_aligned(f.tell()) - f.tell()))
+    os.replace(tmp_path, path) # readers never see a half-written cache
+
+def open_strand_cache(path: str, source_key: tuple[int, int] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Memory-maps (verts, indices, offsets) from a strand cache, or returns None if it's missing or doesn't match <source_key>"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(_CACHE_HEADER_BYTES)
+    except OSError:
+        return None
+    if len(head) < _CACHE_HEADER_BYTES or head[:len(_CACHE_MAGIC)] != _CACHE_MAGIC:
+        return None
+    mtime_ns, size, n_verts, n_indices, n_offsets, itemsize = np.frombuffer(head, dtype = np.int64, count = 6, offset = len(_CACHE_MAGIC))
+    if source_key is not None and (mtime_ns, size) != tuple(source_key):
+        return None
+    arrays = []
+    pos = _CACHE_HEADER_BYTES
+    for dtype, shape in ((np.float32 if itemsize == 4 else np.float64, (int(n_verts), 3)), (np.int32, (int(n_indices),)), (np.int32, (int(n_offsets),))):
+        if np.prod(shape) == 0: # mmap can't map an empty range
+            arrays.append(np.empty(shape, dtype = dtype))
+        else:
+            arrays.append(np.memmap(path, dtype = dtype, mode = "r", offset = pos, shape = shape))
+        pos = _aligned(pos + int(np.prod(shape))*np.dtype(dtype).itemsize)
+    return tuple(arrays)
+
+class animatedCacheWriter:
+    """ Writes the shared topology of an animated strand cache up front, then appends one frame of positions at a time"""
+    def __init__(self, path: str, indices: np.ndarray, offsets: np.ndarray, n_verts: int):
+        assert n_verts < 2**31 and len(indices) < 2**31, "animated cache stores int32 indices"
+        self.path = path
+        self.n_verts = n_verts
+        self.n_frames = 0
+        self.n_indices = len(indices)
+        self.n_offsets = len(offsets)
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.f.write(bytes(_CACHE_HEADER_BYTES)) # filled in by close, once the frame count is known
+        for arr in (np.ascontiguousarray(indices, dtype = np.int32), np.ascontiguousarray(offsets, dtype = np.int32)):
+            self.f.write(arr.tobytes())
+            self.f.write(bytes(_aligned(self.f.tell()) - self.f.tell()))
+
+    def write_frame(self, verts: np.ndarray):
+        assert verts.shape == (self.n_verts, 3), f"frame shape {verts.shape} doesn't match the topology's {(self.n_verts, 3)}"
+        self.f.write(np.ascontiguousarray(verts, dtype = np.float32).tobytes())
+        self.n_frames += 1
+
+    def close(self):
+        """ Writes the header and moves the finished cache into place"""
+        header = np.array([self.n_frames, self.n_verts, self.n_indices, self.n_offsets], dtype = np.int64)
+        self.f.seek(0)
+        self.f.write(_ANIM_MAGIC + header.tobytes())
+        self.f.close()
+        os.replace(self.tmp_path, self.path) # readers never see a half-written cache
+
+    def discard(self):
+        """ Drops a cache that won't be finished"""
+        self.f.close()
+        os.remove(self.tmp_path)
+
+def open_animated_cache(path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Memory-maps (positions shaped (n_frames, n_verts, 3), indices, offsets) from an animated strand cache"""
+    with open(path, "rb") as f:
+        head = f.read(_CACHE_HEADER_BYTES)
+    if len(head) < _CACHE_HEADER_BYTES or head[:len(_ANIM_MAGIC)] != _ANIM_MAGIC:
+        raise ValueError(f"{path} is not an animated strand cache")
+    n_frames, n_verts, n_indices, n_offsets = (int(n) for n in np.frombuffer(head, dtype = np.int64, count = 4, offset = len(_ANIM_MAGIC)))
+    arrays = []
+    pos = _CACHE_HEADER_BYTES
+    for dtype, shape in ((np.int32, (n_indices,)), (np.int32, (n_offsets,)), (np.float32, (n_frames, n_verts, 3))):
+        if np.prod(shape) == 0: # mmap can't map an empty range
+            arrays.append(np.empty(shape, dtype = dtype))
+        else:
+            arrays.append(np.memmap(path, dtype = dtype, mode = "r", offset = pos, shape = shape))
+        pos = _aligned(pos + int(np.prod(shape))*np.dtype(dtype).itemsize)
+    indices, offsets, positions = arrays
+    return positions, indices, offsets
+
+def source_key(filename: str) -> tuple[int, int]:
+    """ (mtime in ns, size) of a file, the key a strand cache is checked against"""
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+def read_obj(filename: str, use_cache: bool = True) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Reads verts plus CSR-style strands (flat indices, offsets) from .obj in a single pass"""
+    # with use_cache, a <filename>.ccache sidecar is memory-mapped when it is still fresh and (re)written when it isn't
+    if use_cache:
+        key = source_key(filename)
+        cached = open_strand_cache(filename + CACHE_SUFFIX, key)
+        if cached is not None:
+            return cached
     with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "v":
-                total_verts += 1
-            line = file.readline()
-    verts = np.empty(shape=(total_verts,3))
-    i = 0
+        verts, indices, offsets = parse_obj_text(file.read())
+    if use_cache:
+        try:
+            write_strand_cache(filename + CACHE_SUFFIX, verts, indices, offsets, key)
+        except OSError: # read-only data dirs just don't get a cache
+            pass
+    return verts, indices, offsets
+
+def csr_to_strands(indices: np.ndarray, offsets: np.ndarray) -> list[np.ndarray]:
+    """ Splits CSR-style strands into a list of per-strand index arrays"""
+    return np.split(indices, offsets[1:-1]) if len(offsets) > 1 else []
+
+def iter_obj_strands(filename: str, start_size: int = 4096):
+    """ Streams an .obj, yielding the (n x 3) verts of each strand in "l" line order"""
+    # the file is read twice at once: one pass walks the "l" lines, the other reads "v" lines only as far as the
+    # current strand needs, and verts before the current strand's first one are dropped. Memory stays around one
+    # strand for export_obj's layout (strands after one another); a strand reaching back before the first vert
+    # of the strand ahead of it raises ValueError, read_obj handles those files
+    with open(filename) as l_file, open(filename) as v_file:
+        v_lines = (line for line in v_file if line[:2] == "v " or line[:2] == "v\t")
+        window = np.empty((start_size, 3))
+        lo = 0 # window[0] is vert lo, and verts lo..hi-1 are held
+        hi = 0
+        for line in l_file:
+            head = line[:2]
+            if head != "l " and head != "l\t":
+                continue
+            inds = np.array(line[2:].split(), dtype = np.int64) - 1 # obj's edges index into verts starting at 1
+            if len(inds) == 0:
+                yield np.empty((0, 3))
+                continue
+            first, last = int(np.min(inds)), int(np.max(inds))
+            if first < lo:
+                raise ValueError(f"{filename}: a strand uses vert {first + 1}, before vert {lo + 1} where the previous strand starts; iter_obj_strands needs strands in file order")
+            drop = min(first, hi) - lo
+            window[:hi - lo - drop] = window[drop:hi - lo]
+            lo = first
+            while hi <= last:
+                v_line = next(v_lines, None)
+                if v_line is None:
+                    raise ValueError(f"{filename}: a strand uses vert {last + 1}, but there are only {hi}")
+                if hi >= lo:
+                    if hi - lo == len(window):
+                        window = np.resize(window, (2*len(window), 3))
+                    window[hi - lo] = v_line[2:].split()[:3]
+                hi += 1
+            yield window[inds - lo]
+
+def vert_read(filename: str, use_cache: bool = True) -> np.ndarray:
+    """ Reads only vertices from an .obj and stores in an np.array"""
+    if use_cache:
+        return read_obj(filename)[0]
     with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "v":
-                verts[i] = line[1:]
-                i += 1
-            line = file.readline()
-    return verts
+        return parse_obj_text(file.read(), read_lines = False)[0]
 
 def edge_root_read(filename: str) -> list:
     """ Reads edge root (indexes into verts) from .obj"""
-    edge_roots = []
-    with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "l":
-                edge_roots.append([int(line[1]) - 1]) # obj's edges index into verts starting at 1 
-                line = file.readline()
-    return edge_roots
-
-def read_obj_strands(filename: str) -> tuple[np.ndarray, list[list[int]]]:
+    _, indices, offsets = read_obj(filename)
+    return [[int(indices[o])] for o in offsets[:-1]]
+
+def read_obj_strands(filename: str, use_cache: bool = True) -> tuple[np.ndarray, list[np.ndarray]]:
     """ Reads verts and edges from .obj"""
-    total_verts = 0
-    with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "v":
-                total_verts += 1
-            line = file.readline()
-    verts = np.empty(shape=(total_verts,3))
-    edges = []
-    i = 0
-    with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "v":
-                verts[i] = line[1:]
-                i += 1
-            if line[0] == "l":
-                strand = []
-                for j in range(1,len(line)):
-                    strand.append(int(line[j]) - 1)
-                edges.append(strand[:])
-            line = file.readline()
-    return verts, edges
+    verts, indices, offsets = read_obj(filename, use_cache)
+    return verts, csr_to_strands(indices, offsets)
 
-def read_obj_strands_blended(filename: str) -> tuple[np.ndarray, list[list[int]]]:
+def read_obj_strands_blended(filename: str, use_cache: bool = True) -> tuple[np.ndarray, list[np.ndarray]]:
     """ Reads verts and edges from .obj, then attempts to collate individual edges into long strand"""
-    total_verts = 0
-    with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "v":
-                total_verts += 1
-            line = file.readline()
-    verts = np.empty(shape=(total_verts,3))
-    edges = []
-    i = 0
-    strand = []
-    with open(filename) as file:
-        line = file.readline()
-        while line:
-            line = line.split()
-            if line[0] == "v":
-                verts[i] = line[1:]
-                i += 1
-            if line[0] == "l":
-                if strand == []:
-                    strand = [int(line[1]) - 1, int(line[2]) - 1]
-                elif strand[len(strand) - 1] != int(line[1]) - 1:
-                    if strand != []:
-                        edges.append(strand[:])
-                    strand = [int(line[1]) - 1, int(line[2]) - 1]
-                else:
-                    strand.append(int(line[2]) - 1)
-            line = file.readline()
+    verts, indices, offsets = read_obj(filename, use_cache)
+    if len(offsets) < 2:
+        return verts, []
+    starts = indices[offsets[:-1]]
+    ends = indices[offsets[:-1] + 1]
+    # a new strand begins wherever a segment doesn't pick up from the previous segment's end
+    breaks = np.nonzero(starts[1:] != ends[:-1])[0] + 1
+    bounds = np.concatenate(([0], breaks, [len(starts)]))
+    edges = [np.concatenate(([starts[b0]], ends[b0:b1])) for b0, b1 in zip(bounds[:-1], bounds[1:])]
     return verts, edges
 
 def verts_to_displacements(p: np.ndarray) -> np.ndarray:
@@ -115,17 +242,99 @@ def displacements_to_verts(d: np.ndarray, v0: np.ndarray) -> np.ndarray:
         vs[i+1] = v0 + tol_d
     return vs
 
+def strands_to_csr(strands: list) -> tuple[np.ndarray, np.ndarray]:
+    """ Packs a list of per-strand index sequences into flat indices and CSR offsets"""
+    offsets = np.zeros(len(strands) + 1, dtype = np.int64)
+    np.cumsum([len(s) for s in strands], out = offsets[1:])
+    if len(strands) == 0:
+        return np.empty(0, dtype = np.int64), offsets
+    return np.concatenate(strands).astype(np.int64), offsets
+
 # ASSUMES v is 3D
-def export_obj(verts: np.ndarray, strands: list, filename: str):
+def export_obj(verts: np.ndarray, strands: list, filename: str, mtllib: str = None, material: str = None, precision: int = None):
     """Outputs verts and strands into obj"""
+    indices, offsets = strands_to_csr(strands)
+    export_obj_csr(verts, indices, offsets, filename, mtllib, material, precision)
+
+def export_obj_csr(verts: np.ndarray, indices: np.ndarray, offsets: np.ndarray, filename: str, mtllib: str = None, material: str = None, precision: int = None, block: int = 65536):
+    """Outputs verts and CSR-style strands into obj, optionally headed by mtllib/usemtl lines"""
+    # each block of lines is one %-format over a flat tuple; %r prints floats exactly like f"{v[0]}" does,
+    # a <precision> in significant digits trades that round-trip exactness for roughly 3x faster formatting
+    v_fmt = "v %r %r %r\n" if precision is None else f"v %.{precision}g %.{precision}g %.{precision}g\n"
     with open(filename, "w", newline="") as f:
-        for v in verts:
-            f.write(f"v {v[0]} {v[1]} {v[2]}\n")
-        for s in strands:
-            f.write("l")
-            for n in s:
-                f.write(f" {n+1}")
-            f.write("\n")
+        if mtllib is not None:
+            f.write(f"mtllib {mtllib}\n")
+        if material is not None:
+            f.write(f"usemtl {material}\n")
+        for b in range(0, len(verts), block):
+            chunk = np.asarray(verts[b:b + block], dtype = np.float64)
+            f.write((v_fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+        counts = np.diff(offsets).tolist()
+        ones = (np.asarray(indices) + 1).tolist()
+        s = 0
+        while s < len(counts):
+            e = s + 1
+            while e < len(counts) and offsets[e + 1] - offsets[s] <= block:
+                e += 1
+            fmt = "".join(["l" + " %d"*c + "\n" for c in counts[s:e]])
+            f.write(fmt % tuple(ones[offsets[s]:offsets[e]]))
+            s = e
+
+def export_strands_json(verts: np.ndarray, indices: np.ndarray, offsets: np.ndarray, filename: str):
+    """Outputs CSR-style strands as a json list of strands, each a list of [x, y, z] points"""
+    with open(filename, "w", newline="") as f:
+        f.write("[")
+        for k in range(len(offsets) - 1):
+            pts = np.asarray(verts[indices[offsets[k]:offsets[k + 1]]], dtype = np.float64)
+            if k > 0:
+                f.write(", ")
+            f.write("[" + ", ".join(["[%r, %r, %r]"]*len(pts)) % tuple(pts.ravel().tolist()) + "]")
+        f.write("]")
+
+# binary strand payload for web clients: a 48 byte little-endian header, then positions, then uint32 strand offsets
+#   magic "CCHR" | u32 version | u32 flags (bit 0: int16 positions) | u32 n_verts | u32 n_strands | f32 center[3] | f32 scale[3] | u32 reserved
+# positions are float32 xyz, or int16 xyz decoding to center + q*scale; the offsets start 4-byte aligned
+BINARY_MAGIC = b"CCHR"
+BINARY_VERSION = 1
+BINARY_QUANTIZED = 1
+
+def pack_strands_binary(verts: np.ndarray, indices: np.ndarray, offsets: np.ndarray, quantize: bool = False) -> bytes:
+    """Packs CSR-style strands into the binary payload (positions in strand order + uint32 offsets)"""
+    pts = np.asarray(verts[indices], dtype = np.float64).reshape(-1, 3)
+    if quantize and len(pts) > 0:
+        lo = pts.min(axis = 0)
+        hi = pts.max(axis = 0)
+        center = (lo + hi)/2
+        scale = np.maximum((hi - lo)/2, 1e-12)/32767
+        positions = np.round((pts - center)/scale).astype("<i2")
+        flags = BINARY_QUANTIZED
+    else:
+        center = np.zeros(3)
+        scale = np.ones(3)
+        positions = pts.astype("<f4")
+        flags = 0
+    header = np.array([BINARY_VERSION, flags, len(pts), len(offsets) - 1], dtype = "<u4").tobytes()
+    header += np.concatenate((center, scale)).astype("<f4").tobytes() + bytes(4)
+    body = positions.tobytes()
+    body += bytes(-len(body) % 4)
+    return BINARY_MAGIC + header + body + np.asarray(offsets - offsets[0], dtype = "<u4").tobytes()
+
+def unpack_strands_binary(payload: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """Reads a binary payload back into float (n x 3) positions and strand offsets"""
+    assert payload[:4] == BINARY_MAGIC, "not a binary strand payload"
+    version, flags, n_verts, n_strands = np.frombuffer(payload, dtype = "<u4", count = 4, offset = 4)
+    center_scale = np.frombuffer(payload, dtype = "<f4", count = 6, offset = 20).astype(np.float64)
+    pos = 48
+    if flags & BINARY_QUANTIZED:
+        q = np.frombuffer(payload, dtype = "<i2", count = 3*int(n_verts), offset = pos).reshape(-1, 3)
+        positions = center_scale[:3] + q*center_scale[3:]
+        pos += q.nbytes
+    else:
+        positions = np.frombuffer(payload, dtype = "<f4", count = 3*int(n_verts), offset = pos).reshape(-1, 3).astype(np.float64)
+        pos += positions.size*4
+    pos += -pos % 4
+    offsets = np.frombuffer(payload, dtype = "<u4", count = int(n_strands) + 1, offset = pos).astype(np.int64)
+    return positions, offsets
 
 def export_strand(verts: np.ndarray, filename: str):
     """Outputs contiguous strand of verts assuming they're all sequentially connected"""
@@ -136,57 +345,72 @@ def export_strand(verts: np.ndarray, filename: str):
         for i in range(0, len(verts)):
             f.write(f" {i+1}")
 
+def row_norms(x: np.ndarray) -> np.ndarray:
+    """Norms over the last axis, kept as a trailing axis of size 1"""
+    # matmul goes through the same dot kernel as np.linalg.norm on a single vector, so results match bit for bit
+    return np.sqrt(np.matmul(x[..., None, :], x[..., :, None]))[..., 0]
+
+def frames_from_tangents(w: np.ndarray, up: np.ndarray) -> np.ndarray:
+    """Builds (u, v, w) frames from tangents shaped (..., 3) and an up vector that broadcasts against them"""
+    w = w/row_norms(w)
+    u = np.cross(up, w)
+    u = u/row_norms(u)
+    v = np.cross(w, u)
+    v = v/row_norms(v)
+    return np.stack((u, v, w), axis = -2)
+
+def strand_tangents(verts: np.ndarray[np.ndarray]) -> np.ndarray[np.ndarray]:
+    """Point-wise tangents of a strand: catmull-rom from 4 verts on, forward differencing below that"""
+    w = np.empty(verts.shape)
+    if len(verts) == 1: # can't even do forward differencing
+        w[0] = verts[0]
+        return w
+    if len(verts) < 4: # there's no Catmull explanation for this. Just do forward tangent
+        w[:-1] = verts[1:] - verts[:-1]
+        w[-1] = verts[-1] - verts[-2]
+        return w
+    w[0] = verts[2] - verts[0] - 0.5*(verts[3] - verts[1])
+    w[1:-1] = 0.5*(verts[2:] - verts[:-2])
+    w[-1] = verts[-1] - verts[-3] - 0.5*(verts[-2] - verts[-4])
+    return w
+
 def make_frames(verts: np.ndarray[np.ndarray], up: np.ndarray) -> np.ndarray[np.ndarray[np.ndarray]]:
     """From list of vertices and a starting vector, obtain list of frames with point-wise tangents"""
-    frames = np.empty((len(verts),3,3))
-
-    # tangents derived from catmull-rom spline interpolation
-    if len(frames) == 1: # can't even do forward differencing
-        w = verts[0]
-        w = w/np.linalg.norm(w)
-        u = np.cross(up, w)
-        u = u/np.linalg.norm(u)
-        v = np.cross(w, u)
-        v = v/np.linalg.norm(v)
-        frames[0][0] = u[:]
-        frames[0][1] = v[:]
-        frames[0][2] = w[:]
-        return frames
-
-    if len(frames) < 4: # there's no Catmull explanation for this. Just do forward tangent
-        for i in range(0, len(frames)):
-            w = np.empty(3)
-            if i == len(frames) - 1:
-                w = verts[i] - verts[i-1]
-            else:
-                w = verts[i+1] - verts[i]
-            w = w/np.linalg.norm(w)
-            u = np.cross(up, w)
-            u = u/np.linalg.norm(u)
-            v = np.cross(w, u)
-            v = v/np.linalg.norm(v)
-            frames[i][0] = u[:]
-            frames[i][1] = v[:]
-            frames[i][2] = w[:]
-        return frames
-
-    for i in range(0, len(frames)):
-        # first get the tangent
-        w = np.empty(3)
-        if i == 0:
-            w = verts[2] - verts[0] - 0.5*(verts[3] - verts[1])
-        elif i == len(frames) - 1:
-            w = verts[i] - verts[i-2] - 0.5*(verts[i-1] - verts[i-3])
-        else:
-            w = 0.5*(verts[i+1] - verts[i-1])
-        w = w/np.linalg.norm(w)
-        u = np.cross(up, w)
-        u = u/np.linalg.norm(u)
-        v = np.cross(w, u)
-        v = v/np.linalg.norm(v)
-        frames[i][0] = u[:]
-        frames[i][1] = v[:]
-        frames[i][2] = w[:]
+    return frames_from_tangents(strand_tangents(verts), up)
+
+def length_mask(lengths: np.ndarray, max_len: int) -> np.ndarray:
+    """(n, max_len) boolean mask of the valid entries of a padded strand batch"""
+    return np.arange(max_len)[None, :] < np.asarray(lengths)[:, None]
+
+def strand_tangents_batch(verts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """strand_tangents over a padded (n, max_len, 3) batch where strand k only uses its first lengths[k] verts"""
+    lengths = np.asarray(lengths)
+    rows = np.arange(len(verts))
+    last = lengths - 1
+    w = np.zeros(verts.shape)
+    w[:, 1:-1] = 0.5*(verts[:, 2:] - verts[:, :-2])
+
+    short = lengths < 4
+    w[short, :-1] = verts[short, 1:] - verts[short, :-1]
+    pair = short & (lengths > 1)
+    r, l = rows[pair], last[pair]
+    w[r, l] = verts[r, l] - verts[r, l-1]
+    single = lengths == 1
+    w[single, 0] = verts[single, 0]
+
+    long = ~short
+    if np.any(long):
+        r, l = rows[long], last[long]
+        w[r, 0] = verts[r, 2] - verts[r, 0] - 0.5*(verts[r, 3] - verts[r, 1])
+        w[r, l] = verts[r, l] - verts[r, l-2] - 0.5*(verts[r, l-1] - verts[r, l-3])
+    return w
+
+def make_frames_batch(verts: np.ndarray, up: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """make_frames over a padded (n, max_len, 3) batch; <up> is one vector or one per strand, padded frames are zero"""
+    mask = length_mask(lengths, verts.shape[1])
+    ups = np.broadcast_to(np.asarray(up, dtype = float).reshape(-1, 1, 3), verts.shape)
+    frames = np.zeros((*verts.shape[:2], 3, 3))
+    frames[mask] = frames_from_tangents(strand_tangents_batch(verts, lengths)[mask], ups[mask])
     return frames
 
 def clumping_read(filename: str)->list[list[int]]:
@@ -211,3 +435,12 @@ def par_shift(verts: np.ndarray[np.ndarray], up:np.ndarray, x: float, y: float,
     facs = grow_map(ts)
     new_verts = verts + x*np.transpose(facs*np.transpose(frames[:,0])) + y*np.transpose(facs*np.transpose(frames[:,1]))
     return new_verts
+
+
+def par_shift_batch(verts: np.ndarray[np.ndarray], frames: np.ndarray, xs: np.ndarray, ys: np.ndarray, grow_map) -> np.ndarray:
+    """par_shift for a whole set of (x, y) offsets at once, reusing the frames of <verts>; returns (len(xs), len(verts), 3)"""
+    ts = np.linspace(0, 1, len(verts))
+    facs = grow_map(ts)
+    x_facs = np.outer(xs, facs)[:, :, None]
+    y_facs = np.outer(ys, facs)[:, :, None]
+    return verts[None] + x_facs*frames[None, :, 0] + y_facs*frames[None, :, 1]
@@ -0,0 +1,91 @@
+# Per-stage timers, counters and progress events for the generation pipeline, replacing the stdout percentage prints
+
+import datetime
+import time
+from contextlib import contextmanager
+
+class stageTimer:
+    """ Accumulates wall time and calls per named stage plus named counts, and forwards events to a listener"""
+    def __init__(self, listener = None):
+        # <listener>, if given, is called with every event dict ({"type": ..., "time": ..., ...})
+        self.listener = listener
+        self.seconds = {}
+        self.calls = {}
+        self.counts = {}
+        self.open = [] # [stage name, seconds spent in nested stages] of the stages running right now
+
+    @contextmanager
+    def stage(self, name: str):
+        """ Times the block as stage <name>; time spent in stages nested inside it is only counted for those"""
+        self.open.append([name, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _, nested = self.open.pop()
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - nested
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.open:
+                self.open[-1][1] += elapsed
+
+    def count(self, name: str, n: int):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def emit(self, kind: str, **data):
+        if self.listener is not None:
+            self.listener({"type": kind, "time": time.time(), **data})
+
+    def summary(self) -> dict:
+        """ {"stages": {name: {"seconds", "calls"}}, "counts": {name: n}}, json-ready"""
+        return {
+            "stages": {name: {"seconds": self.seconds[name], "calls": self.calls[name]} for name in self.seconds},
+            "counts": dict(self.counts),
+        }
+
+def print_event(event: dict):
+    """ Listener for command line runs: one timestamped line per event"""
+    stamp = datetime.datetime.fromtimestamp(event["time"])
+    if event["type"] == "progress":
+        print(f"{stamp}: reached {event['percent']}%", flush = True)
+    elif event["type"] == "summary":
+        stages = ", ".join(f"{name} {s['seconds']:.3f}s/{s['calls']}" for name, s in event["stages"].items())
+        counts = ", ".join(f"{name} {n}" for name, n in event["counts"].items())
+        print(f"{stamp}: stages: {stages}; counts: {counts}", flush = True)
+    else:
+        details = ", ".join(f"{k} {v}" for k, v in event.items() if k not in ("type", "time"))
+        print(f"{stamp}: {event['type']}{': ' + details if details else ''}", flush = True)
+
+class metricsRegistry:
+    """ Running totals of the summaries of finished jobs, rendered in the Prometheus text format"""
+    def __init__(self, prefix: str = "curly"):
+        self.prefix = prefix
+        self.jobs = {}
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counts = {}
+
+    def record_job(self, status: str, summary: dict = None):
+        self.jobs[status] = self.jobs.get(status, 0) + 1
+        if summary is None:
+            return
+        for name, s in summary["stages"].items():
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + s["seconds"]
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + s["calls"]
+        for name, n in summary["counts"].items():
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def render(self, gauges: dict = None) -> str:
+        """ The exposition text; <gauges> adds current values such as queue depth"""
+        p = self.prefix
+        lines = [f"# TYPE {p}_jobs_total counter"]
+        lines += [f'{p}_jobs_total{{status="{status}"}} {n}' for status, n in sorted(self.jobs.items())]
+        lines.append(f"# TYPE {p}_stage_seconds_total counter")
+        lines += [f'{p}_stage_seconds_total{{stage="{name}"}} {s:.6f}' for name, s in sorted(self.stage_seconds.items())]
+        lines.append(f"# TYPE {p}_stage_calls_total counter")
+        lines += [f'{p}_stage_calls_total{{stage="{name}"}} {n}' for name, n in sorted(self.stage_calls.items())]
+        for name, n in sorted(self.counts.items()):
+            lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {n}"]
+        for name, value in sorted((gauges or {}).items()):
+            lines += [f"# TYPE {p}_{name} gauge", f"{p}_{name} {value}"]
+        return "\n".join(lines) + "\n"
@@ -3,63 +3,56 @@
 import numpy as np
 
 class octreeNode:
-    def __init__(self, data, max_coords, min_coords):
-        self.points = data
+    def __init__(self, inds, max_coords, min_coords, all_points = None):
+        self.inds = inds # indices into all_points (leaves only), the tree never copies coordinates
+        self.all_points = all_points
         self.children = []
         self.max_coords = np.array(max_coords)
         self.min_coords = np.array(min_coords)
         self.is_leaf = False
 
-# helper for octree initialization: makes the octants and populates them (a dictionary) 
-def oct_split(points, max, min):
+# helper for octree initialization: makes the octants and populates them (a dictionary of point indices)
+def oct_split(points, inds, max, min):
     avg = (np.array(max) + np.array(min)) / 2
-    split_dict = {"uuu":[], "uud":[], "udu":[], "udd":[], "duu":[], "dud":[], "ddu":[], "ddd":[]}
-    for p in points:
-        split = ""
-        if p[0] > avg[0]:
-            split += 'u'
-        else:
-            split += 'd'
-        if p[1] > avg[1]:
-            split += 'u'
-        else:
-            split += 'd'
-        if p[2] > avg[2]:
-            split += 'u'
-        else:
-            split += 'd'
-        split_dict[split].append(p)
+    above = points[inds] > avg
+    split_dict = {}
+    for key in ["uuu", "uud", "udu", "udd", "duu", "dud", "ddu", "ddd"]:
+        want = np.array([c == 'u' for c in key])
+        split_dict[key] = inds[np.all(above == want, axis = 1)]
     return split_dict
 
 # makes the octree out of the big array of points
-def make_octree(all_points : np.ndarray, threshold : float, u : np.ndarray, d : np.ndarray) -> octreeNode:
-    if len(all_points) < threshold: # base case it's a leaf
-        leaf_node = octreeNode(all_points, u, d)
+def make_octree(all_points : np.ndarray, threshold : float, u : np.ndarray, d : np.ndarray, inds : np.ndarray = None) -> octreeNode:
+    all_points = np.asarray(all_points)
+    if inds is None:
+        inds = np.arange(len(all_points))
+    if len(inds) < threshold: # base case it's a leaf
+        leaf_node = octreeNode(inds, u, d, all_points)
         leaf_node.is_leaf = True
         return leaf_node
     #otherwise chop it up into 8 parts and go again
-    split_dict = oct_split(all_points, u, d)
-    root_node = octreeNode(None, u, d)
+    split_dict = oct_split(all_points, inds, u, d)
+    root_node = octreeNode(None, u, d, all_points)
     avg = (np.array(u) + np.array(d)) / 2
     if len(split_dict["uuu"]) > 0:
-       root_node.children.append(make_octree(split_dict["uuu"], threshold, u, avg))
+       root_node.children.append(make_octree(all_points, threshold, u, avg, split_dict["uuu"]))
     if len(split_dict["uud"]) > 0:
-        root_node.children.append(make_octree(split_dict["uud"], threshold, [u[0], u[1], avg[2]], [avg[0], avg[1], d[2]]))
+        root_node.children.append(make_octree(all_points, threshold, [u[0], u[1], avg[2]], [avg[0], avg[1], d[2]], split_dict["uud"]))
     if len(split_dict["udu"]) > 0:
-        root_node.children.append(make_octree(split_dict["udu"], threshold, [u[0], avg[1], u[2]], [avg[0], d[1], avg[2]]))
+        root_node.children.append(make_octree(all_points, threshold, [u[0], avg[1], u[2]], [avg[0], d[1], avg[2]], split_dict["udu"]))
     if len(split_dict["udd"]) > 0:
-        root_node.children.append(make_octree(split_dict["udd"], threshold, [u[0], avg[1], avg[2]], [avg[0], d[1], d[2]]))
+        root_node.children.append(make_octree(all_points, threshold, [u[0], avg[1], avg[2]], [avg[0], d[1], d[2]], split_dict["udd"]))
     if len(split_dict["duu"]) > 0:
-        root_node.children.append(make_octree(split_dict["duu"], threshold, [avg[0], u[1], u[2]], [d[0], avg[1], avg[2]]))
+        root_node.children.append(make_octree(all_points, threshold, [avg[0], u[1], u[2]], [d[0], avg[1], avg[2]], split_dict["duu"]))
     if len(split_dict["dud"]) > 0:
-        root_node.children.append(make_octree(split_dict["dud"], threshold, [avg[0], u[1], avg[2]], [d[0], avg[1], d[2]]))
+        root_node.children.append(make_octree(all_points, threshold, [avg[0], u[1], avg[2]], [d[0], avg[1], d[2]], split_dict["dud"]))
     if len(split_dict["ddu"]) > 0:
-        root_node.children.append(make_octree(split_dict["ddu"], threshold, [avg[0], avg[1], u[2]], [d[0], d[1], avg[2]]))
+        root_node.children.append(make_octree(all_points, threshold, [avg[0], avg[1], u[2]], [d[0], d[1], avg[2]], split_dict["ddu"]))
     if len(split_dict["ddd"]) > 0:
-        root_node.children.append(make_octree(split_dict["ddd"], threshold, avg, d))
+        root_node.children.append(make_octree(all_points, threshold, avg, d, split_dict["ddd"]))
     return root_node
 
-# quick octree for finding coarse neighbors
+# quick octree for finding coarse neighbors (as indices into the tree's points)
 def get_close_guess(v : np.ndarray, root : octreeNode, eps : float) -> list:
     # first determine if vert is even within eps of box
     neighbors = []
@@ -71,64 +64,33 @@ def get_close_guess(v : np.ndarray, root : octreeNode, eps : float) -> list:
         return neighbors
     # terminate if leaf
     if root.is_leaf:
-        return root.points
+        return list(root.inds)
     # otherwise it's branching: better append neighbors a bit!
     for child in root.children:
         neighbors.extend(get_close_guess(v, child, eps))
     return neighbors
 
-# finding neighbors of a vert from an octree
-def closest_guide_ind_faster(vert : np.ndarray, guide_octree : octreeNode, eps : float) -> tuple[np.ndarray, float, np.ndarray, float]:
-    coarse_neighbors = get_close_guess(vert, guide_octree, eps)
-    new_eps = eps
-    while len(coarse_neighbors) <= 1:
-        new_eps = 2*new_eps
-        # print(f"new_eps: {new_eps}")
-        coarse_neighbors = get_close_guess(vert, guide_octree, new_eps)
-    closest_dist2 = np.sum((vert - np.array(coarse_neighbors[0]))**2)
-    closest_dist2_second = np.sum((vert - np.array(coarse_neighbors[0]))**2)
-    closest_p = np.array(coarse_neighbors[0])
-    closest_p_second = np.array(coarse_neighbors[0])
-    # print(f"coarse_neighbors len: {len(coarse_neighbors)}")
-    for p in coarse_neighbors:
-        cand_dist2 = np.sum((vert - p)**2)
-        if cand_dist2 < closest_dist2:
-            closest_p_second = closest_p
-            closest_p = p
-            closest_dist2_second = closest_dist2
-            closest_dist2 = cand_dist2
-            continue
-        if cand_dist2 < closest_dist2_second:
-            closest_dist2_second = cand_dist2
-            closest_p_second = p
-    return closest_p, closest_dist2, closest_p_second, closest_dist2_second
+# finding the two closest points to a vert from an octree
+# returns tuple: closest index, its square distance, second closest index, its square distance
+def closest_guide_ind_faster(vert : np.ndarray, guide_octree : octreeNode, eps : float) -> tuple[int, float, int, float]:
+    inds, d2s = closest_guide_inds(vert, guide_octree, eps, 2)
+    return int(inds[0]), float(d2s[0]), int(inds[-1]), float(d2s[-1])
 
 # gets n closest guide indices inside guide_octree
 # returns tuple: 
-# list of indices (ordered by 1st closest to nth closest), list of square distances (also ordered)
-def closest_guide_inds(vert: np.ndarray, guide_octree: octreeNode, eps: float, n: int) -> tuple[np.ndarray[np.ndarray], np.ndarray[float]]:
+# array of indices (ordered by 1st closest to nth closest), array of square distances (also ordered)
+def closest_guide_inds(vert: np.ndarray, guide_octree: octreeNode, eps: float, n: int) -> tuple[np.ndarray, np.ndarray]:
+    n = min(n, len(guide_octree.all_points))
     coarse_neighbors = get_close_guess(vert, guide_octree, eps)
     new_eps = eps
     while len(coarse_neighbors) < n:
         new_eps = 2*new_eps
         # print(f"new_eps: {new_eps}")
         coarse_neighbors = get_close_guess(vert, guide_octree, new_eps)
-    close_ps = np.empty((n, 3))
-    close_d2s = np.empty(n)
-    for i in range(n):
-        close_ps[i] = (np.array(coarse_neighbors[0][:]))
-        close_d2s[i] = (float('inf'))
-    # print(f"coarse_neighbors len: {len(coarse_neighbors)}")
-    for p in coarse_neighbors:
-        cand_dist2 = np.sum((vert - p)**2)
-        for i in range(n): # slice the distance and point into the correct place
-            if cand_dist2 < close_d2s[i]:
-                close_d2s[i+1:] = close_d2s[i:-1]
-                close_ps[i+1:] = close_ps[i:-1]
-                close_d2s[i] = cand_dist2
-                close_ps[i] = p[:]
-                break
-    return close_ps, close_d2s
+    cand = np.array(coarse_neighbors)
+    cand_d2s = np.sum((guide_octree.all_points[cand] - vert)**2, axis = 1)
+    order = np.lexsort((cand, cand_d2s))[:n] # ties go to the lower index
+    return cand[order], cand_d2s[order]
 
 def average_leaf_diam(root: octreeNode) -> float:
     if root == None:
@@ -136,4 +98,106 @@ def average_leaf_diam(root: octreeNode) -> float:
     if root.is_leaf:
         return np.max(np.array([root.max_coords[0] - root.min_coords[0], root.max_coords[1] - root.min_coords[1], root.max_coords[2] - root.min_coords[2]]))
     distances = np.array([average_leaf_diam(l) for l in root.children])
-    return np.average(distances)
\ No newline at end of file
+    return np.average(distances)
+
+# flat, array-backed alternative to the octree: points are bucketed into a uniform grid and sorted by cell id,
+# so the whole structure is a few arrays and every query point is answered in the same vectorized pass
+class pointGrid:
+    def __init__(self, points: np.ndarray):
+        self.points = np.asarray(points, dtype = float)
+        self.lo = np.min(self.points, axis = 0)
+        self.extent = np.max(self.points, axis = 0) - self.lo
+        self.layouts = {} # cell layouts, keyed on the target points per cell
+
+    def _cells(self, qs: np.ndarray, h: float) -> np.ndarray:
+        return np.floor((qs - self.lo) / h).astype(np.int64)
+
+    def _cell_ids(self, cells: np.ndarray) -> np.ndarray:
+        # 21 bits per axis, offset so that cells just outside the bounding box still get valid ids
+        c = cells + (1 << 20)
+        return (c[..., 0] << 42) | (c[..., 1] << 21) | c[..., 2]
+
+    def layout(self, per_cell: int) -> tuple:
+        """ (cell size, point order, sorted cell ids, cell starts, cell ends) for roughly <per_cell> points per occupied cell"""
+        if per_cell in self.layouts:
+            return self.layouts[per_cell]
+        # start from a cube-root split of the longest side, then resize cells until occupancy is near per_cell
+        # (scalps are surfaces, so a volume-based guess alone would leave most cells empty)
+        h = max(np.max(self.extent), 1e-12) / max(np.ceil(len(self.points)**(1/3)), 1)
+        for _ in range(32):
+            occupancy = len(self.points) / len(np.unique(self._cell_ids(self._cells(self.points, h))))
+            if occupancy < per_cell / 2 and h < 2*np.max(self.extent):
+                h *= 1.5
+            elif occupancy > per_cell * 2 and h > 1e-9:
+                h /= 1.5
+            else:
+                break
+        cell_ids = self._cell_ids(self._cells(self.points, h))
+        order = np.argsort(cell_ids, kind = "stable") # point indices grouped by cell
+        keys, starts = np.unique(cell_ids[order], return_index = True)
+        self.layouts[per_cell] = (h, order, keys, starts, np.append(starts[1:], len(order)))
+        return self.layouts[per_cell]
+
+    def query(self, qs: np.ndarray, k: int, chunk: int = 8192) -> tuple[np.ndarray, np.ndarray]:
+        """ k nearest points for every row of <qs>: (indices, squared distances), both (len(qs), k), nearest first"""
+        qs = np.atleast_2d(np.asarray(qs, dtype = float))
+        k = min(k, len(self.points))
+        out_inds = np.zeros((len(qs), k), dtype = np.int64)
+        out_d2s = np.zeros((len(qs), k))
+        # cells sized so that one ring around a query usually holds k points already
+        grid = self.layout(max(4, (k + 1) // 2))
+        brute_rows = max(1, (1 << 22) // len(self.points))
+        for c in range(0, len(qs), chunk):
+            rows = np.arange(c, min(c + chunk, len(qs)))
+            # queries near the points settle within a ring or two of cells; the rare far-off ones are brute forced
+            for r in (1, 2):
+                if len(rows) == 0:
+                    break
+                rows = self._ring_query(grid, qs, rows, k, r, out_inds, out_d2s)
+            for b in range(0, len(rows), brute_rows):
+                sub = rows[b:b + brute_rows]
+                d2 = np.sum((qs[sub][:, None, :] - self.points[None, :, :])**2, axis = 2)
+                out_inds[sub], out_d2s[sub] = _k_smallest(d2, np.broadcast_to(np.arange(len(self.points)), d2.shape), k)
+        return out_inds, out_d2s
+
+    def _ring_query(self, grid: tuple, qs: np.ndarray, pending: np.ndarray, k: int, r: int, out_inds: np.ndarray, out_d2s: np.ndarray) -> np.ndarray:
+        """ Answers the <pending> queries that can be settled from the cells within <r> of their own; returns the rest"""
+        h, order, keys, starts, ends = grid
+        span = np.arange(-r, r + 1)
+        offs = np.stack(np.meshgrid(span, span, span, indexing = "ij"), axis = -1).reshape(-1, 3)
+        # every (pending query, neighbor cell) pair, then the populated cells among them
+        ids = self._cell_ids(self._cells(qs[pending], h)[:, None, :] + offs[None, :, :])
+        slot = np.clip(np.searchsorted(keys, ids), 0, len(keys) - 1)
+        q_of, cell_of = np.nonzero(keys[slot] == ids)
+        cell_start = starts[slot[q_of, cell_of]]
+        counts = ends[slot[q_of, cell_of]] - cell_start
+        # expand each populated cell into its points, laid out as one padded row of candidates per query
+        q_rep = np.repeat(q_of, counts)
+        n_cand = np.bincount(q_rep, minlength = len(pending))
+        col = np.arange(len(q_rep)) - np.repeat(np.cumsum(n_cand) - n_cand, n_cand)
+        cand = np.zeros((len(pending), max(np.max(n_cand), k)), dtype = np.int64)
+        d2 = np.full(cand.shape, np.inf)
+        cand[q_rep, col] = order[np.repeat(cell_start, counts) + np.arange(len(q_rep)) - np.repeat(np.cumsum(counts) - counts, counts)]
+        d2[q_rep, col] = np.sum((self.points[cand[q_rep, col]] - qs[pending][q_rep])**2, axis = 1)
+        inds, dists = _k_smallest(d2, cand, k)
+        # everything within r cells of a query's cell is at least r*h away from it, so a k-th distance
+        # under that bound can't be beaten by points further out
+        done = (dists[:, -1] <= (r*h)**2) | (n_cand == len(self.points))
+        out_inds[pending[done]] = inds[done]
+        out_d2s[pending[done]] = dists[done]
+        return pending[~done]
+
+def _k_smallest(d2: np.ndarray, inds: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Row-wise k smallest of <d2> (nearest first, ties by index) along with the matching entries of <inds>"""
+    if d2.shape[1] > k:
+        part = np.argpartition(d2, k - 1, axis = 1)
+        kth = np.take_along_axis(d2, part[:, k - 1:k], axis = 1)
+        # widened to every tie with the k-th distance, so the index order below picks among all of them
+        width = max(k, int(np.max(np.sum(d2 <= kth, axis = 1))))
+        if k < width < d2.shape[1]:
+            part = np.argpartition(d2, width - 1, axis = 1)
+        part = part[:, :width]
+        d2 = np.take_along_axis(d2, part, axis = 1)
+        inds = np.take_along_axis(inds, part, axis = 1)
+    order = np.lexsort((inds, d2), axis = 1)[:, :k]
+    return np.take_along_axis(inds, order, axis = 1), np.take_along_axis(d2, order, axis = 1)
@@ -0,0 +1,110 @@
+# The amplitude/angle spectra used for stylization, packed per spectrum length for batched sampling and inverse FFTs
+
+import numpy as np
+import os
+from collections import OrderedDict
+
+import file_io as io
+import dft_testing as dft
+
+class spectrumLibrary:
+    """ Amplitude and angle spectra stacked into one contiguous (count, length, dim) array per spectrum length"""
+    def __init__(self, lengths: np.ndarray, amps: list[np.ndarray], angs: list[np.ndarray], bank_bytes: int = 64*2**20):
+        # <amps>[b] and <angs>[b] stack every spectrum of length <lengths>[b]
+        self.lengths = np.asarray(lengths, dtype = np.int64)
+        self.amps = amps
+        self.angs = angs
+        self.amp_counts = np.array([len(a) for a in self.amps], dtype = np.int64)
+        self.ang_counts = np.array([len(a) for a in self.angs], dtype = np.int64)
+        # a bucket is picked in proportion to the (amps, angs) pairs it holds, the distribution the rejection loop sampled
+        pairs = (self.amp_counts * self.ang_counts).astype(float)
+        self.bucket_cdf = np.cumsum(pairs) / np.sum(pairs)
+        # displacement bank: (bucket, amps id, angs id, kept frequencies) -> read-only irfft, least recently used first
+        self.bank = OrderedDict()
+        self.bank_bytes = 0
+        self.max_bank_bytes = bank_bytes
+
+    @classmethod
+    def from_spectra(cls, amps: list[np.ndarray], angs: list[np.ndarray]) -> "spectrumLibrary":
+        """ Buckets per-strand spectra by length, keeping their order within each bucket"""
+        # only lengths present in both sets can be paired, matching the old "same length" rejection loop
+        lengths = sorted(set(len(a) for a in amps) & set(len(a) for a in angs))
+        return cls(lengths, [np.stack([a for a in amps if len(a) == n]) for n in lengths], [np.stack([a for a in angs if len(a) == n]) for n in lengths])
+
+    @classmethod
+    def from_npz(cls, amps_file: str, angs_file: str) -> "spectrumLibrary":
+        """ Reads the one-entry-per-strand Amps/Angs .npz pair"""
+        amps_container = np.load(amps_file)
+        angs_container = np.load(angs_file)
+        return cls.from_spectra([amps_container[k] for k in amps_container], [angs_container[k] for k in angs_container])
+
+    @classmethod
+    def from_packed(cls, spectra_file: str) -> "spectrumLibrary":
+        """ Reads a packed file written by write_packed"""
+        container = np.load(spectra_file)
+        lengths = container["lengths"]
+        return cls(lengths, [container[f"amps_{n}"] for n in lengths], [container[f"angs_{n}"] for n in lengths])
+
+    def write_packed(self, spectra_file: str):
+        """ Writes the buckets as lengths plus one amps_<length>/angs_<length> stack per bucket"""
+        buckets = {}
+        for n, amps, angs in zip(self.lengths, self.amps, self.angs):
+            buckets[f"amps_{n}"] = amps
+            buckets[f"angs_{n}"] = angs
+        np.savez(spectra_file, lengths = self.lengths, **buckets)
+
+    def sample(self, us: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Maps (n, 2) uniform draws to (bucket, amps index, angs index) picks, uniform over all same-length pairs"""
+        buckets = np.minimum(np.searchsorted(self.bucket_cdf, us[:, 0], side = "right"), len(self.lengths) - 1)
+        # the first draw's position inside its bucket's slice of the cdf picks the amplitude spectrum
+        lo = np.where(buckets > 0, self.bucket_cdf[buckets - 1], 0.0)
+        within = (us[:, 0] - lo) / (self.bucket_cdf[buckets] - lo)
+        amp_inds = np.minimum((within * self.amp_counts[buckets]).astype(np.int64), self.amp_counts[buckets] - 1)
+        ang_inds = np.minimum((us[:, 1] * self.ang_counts[buckets]).astype(np.int64), self.ang_counts[buckets] - 1)
+        return buckets, amp_inds, ang_inds
+
+    def freqs(self, bucket: int, amp_inds: np.ndarray, ang_inds: np.ndarray) -> np.ndarray:
+        """ Complex spectra (len(amp_inds), length, dim) of the given pairs within one bucket"""
+        return dft.polar_to_complex(self.amps[bucket][amp_inds], self.angs[bucket][ang_inds])
+
+    def displacements(self, buckets: np.ndarray, amp_inds: np.ndarray, ang_inds: np.ndarray, curliness: float) -> list[np.ndarray]:
+        """ Low-passed displacements (2*length, dim) of each pick, keeping int(length*curliness) frequencies"""
+        # banked picks are a lookup; the missing ones of each bucket are built with one stacked irfft and banked
+        out = [None]*len(buckets)
+        missing = {}
+        for k, key in enumerate(zip(buckets.tolist(), amp_inds.tolist(), ang_inds.tolist())):
+            key = (*key, int(self.lengths[key[0]] * curliness))
+            d = self.bank.get(key)
+            if d is None:
+                missing.setdefault(key[0], []).append(k)
+            else:
+                self.bank.move_to_end(key)
+                out[k] = d
+        for bucket, inds in missing.items():
+            spec_len = self.lengths[bucket]
+            freqs = self.freqs(bucket, amp_inds[inds], ang_inds[inds])
+            num_freqs = int(spec_len * curliness)
+            freqs[:, num_freqs:] = 0
+            stacked = np.fft.irfft(freqs, axis = 1, n = 2*spec_len)
+            stacked.flags.writeable = False
+            for k, d in zip(inds, stacked):
+                out[k] = d
+                key = (bucket, int(amp_inds[k]), int(ang_inds[k]), num_freqs)
+                if key not in self.bank:
+                    self.bank[key] = d
+                    self.bank_bytes += d.nbytes
+        while self.bank_bytes > self.max_bank_bytes and self.bank:
+            self.bank_bytes -= self.bank.popitem(last = False)[1].nbytes
+        return out
+
+# libraries already loaded in this process, keyed on the files' identities
+_libraries = {}
+
+def load_library(amps_file: str, angs_file: str = None) -> spectrumLibrary:
+    """ Returns the library for these files, loading it only on first use (or after the files change)"""
+    # without <angs_file>, <amps_file> is a packed spectra file
+    paths = (amps_file,) if angs_file is None else (amps_file, angs_file)
+    key = tuple((os.path.abspath(path), *io.source_key(path)) for path in paths)
+    if key not in _libraries:
+        _libraries[key] = spectrumLibrary.from_packed(amps_file) if angs_file is None else spectrumLibrary.from_npz(amps_file, angs_file)
+    return _libraries[key]
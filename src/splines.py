@@ -0,0 +1,132 @@
+# Hermite/catmull-rom curve evaluation and arc-length resampling, vectorized over samples and over batches of curves
+# every function takes a single curve (n, 3) or a stack of equal-length curves (k, n, 3), with matching ts (m,) or (k, m)
+
+import numpy as np
+
+import file_io as io
+
+def distance_accumulate(pts: np.ndarray) -> np.ndarray:
+    """ Cumulative arc length along (..., n, 3) points, starting at 0"""
+    steps = io.row_norms(np.diff(pts, axis = -2))[..., 0]
+    ds = np.zeros(pts.shape[:-1])
+    ds[..., 1:] = np.cumsum(steps, axis = -1)
+    return ds
+
+def hermite(p0: np.ndarray, m0: np.ndarray, p1: np.ndarray, m1: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """ Cubic Hermite segment(s) at local parameters <ts>; points and tangents broadcast as (..., 3) against ts[..., None]"""
+    ts = ts[..., None]
+    t3 = ts**3
+    t2 = ts**2
+    return p0 * (2 * t3 - 3 * t2 + 1) + m0 * (t3 - 2 * t2 + ts) + p1 * (3 * t2 - 2 * t3) + m1 * (t3 - t2)
+
+def bez(v0: np.ndarray, m0: np.ndarray, v1: np.ndarray, m1: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """ The Hermite curve from v0 to v1 (each (3,) or (k, 3)) sampled at ts"""
+    return hermite(v0[..., None, :], m0[..., None, :], v1[..., None, :], m1[..., None, :], ts)
+
+def interp_batch(x: np.ndarray, xp: np.ndarray, fp: np.ndarray, chunk: int = 1024) -> np.ndarray:
+    """ np.interp(x[i], xp[i], fp[i]) for every row of (k, m) x against (k, n) increasing xp, fp"""
+    out = np.empty(x.shape)
+    for c in range(0, len(x), chunk):
+        xc, xpc, fpc = x[c:c + chunk], xp[c:c + chunk], fp[c:c + chunk]
+        # j is the last sample at or below x, as np.interp's search finds it
+        j = np.sum(xpc[:, None, :] <= xc[:, :, None], axis = -1) - 1
+        j0 = np.clip(j, 0, xp.shape[1] - 1)
+        j1 = np.minimum(j0 + 1, xp.shape[1] - 1)
+        x0, x1 = np.take_along_axis(xpc, j0, 1), np.take_along_axis(xpc, j1, 1)
+        f0, f1 = np.take_along_axis(fpc, j0, 1), np.take_along_axis(fpc, j1, 1)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            vals = (f1 - f0)/(x1 - x0)*(xc - x0) + f0
+        vals = np.where((j0 == xp.shape[1] - 1) | (x0 == xc), f0, vals) # on a sample (or past the end) it is just that sample
+        out[c:c + chunk] = np.where(j < 0, fpc[:, :1], vals)
+    return out
+
+def even_bez(v0: np.ndarray, m0: np.ndarray, v1: np.ndarray, m1: np.ndarray, res: int) -> np.ndarray:
+    """ <res> points evenly spaced by arc length along the Hermite curve from v0 to v1"""
+    ts = np.linspace(0, 1, res)
+    pts = bez(v0, m0, v1, m1, ts)
+    distances = distance_accumulate(pts)
+    even_distances = np.linspace(0, distances[..., -1], res, axis = -1)
+    if pts.ndim == 2:
+        even_times = np.interp(even_distances, distances, ts)
+    else:
+        even_times = interp_batch(even_distances, distances, np.broadcast_to(ts, distances.shape))
+    return bez(v0, m0, v1, m1, even_times)
+
+def even_bez_padded(v0: np.ndarray, m0: np.ndarray, v1: np.ndarray, m1: np.ndarray, res: np.ndarray) -> np.ndarray:
+    """ even_bez of (k, 3) curves with <res>[k] points each, stacked as (k, max(res), 3) with each curve's end point repeated past its res"""
+    res = np.asarray(res)
+    steps = np.arange(np.max(res))[None, :]
+    last = res[:, None] - 1
+    # the same parameters np.linspace gives each curve, held at 1 past the curve's own end
+    ts = np.where(steps >= last, 1.0, steps*(1/last))
+    pts = bez(v0, m0, v1, m1, ts)
+    distances = distance_accumulate(pts) # the repeated end points add no length
+    total = distances[:, -1:]
+    even_distances = np.where(steps >= last, total, steps*(total/last))
+    return bez(v0, m0, v1, m1, interp_batch(even_distances, distances, ts))
+
+def catmull_tangents(vs: np.ndarray) -> np.ndarray:
+    """ Per-vertex tangents of (..., n, 3) control points: central differences inside, extrapolated ones at the ends"""
+    n = vs.shape[-2]
+    ms = np.empty(vs.shape)
+    if n == 3:
+        ms[..., 0, :] = vs[..., 2, :] - vs[..., 0, :] - 0.5*(vs[..., 2, :] - vs[..., 1, :])
+        ms[..., 1, :] = 0.5*(vs[..., 2, :] - vs[..., 0, :])
+        ms[..., 2, :] = vs[..., 2, :] - vs[..., 0, :] - 0.5*(vs[..., 1, :] - vs[..., 0, :])
+        return ms
+    ms[..., 1:-1, :] = 0.5*(vs[..., 2:, :] - vs[..., :-2, :])
+    ms[..., 0, :] = vs[..., 2, :] - vs[..., 0, :] - 0.5 * (vs[..., 3, :] - vs[..., 1, :])
+    ms[..., -1, :] = vs[..., -1, :] - vs[..., -3, :] - 0.5*(vs[..., -2, :] - vs[..., -4, :])
+    return ms
+
+class catmullCurves:
+    """ Catmull-rom curves through (n, 3) or (k, n, 3) control points, with their tangents computed once"""
+    def __init__(self, vs: np.ndarray):
+        self.vs = np.asarray(vs, dtype = float)
+        self.n = self.vs.shape[-2]
+        self.ms = catmull_tangents(self.vs) if self.n >= 3 else None
+
+    def __call__(self, ts: np.ndarray) -> np.ndarray:
+        """ Points at global parameters ts in [0, 1]"""
+        ts = np.asarray(ts, dtype = float)
+        if self.vs.ndim == 3 and ts.ndim == 1: # one set of parameters shared by the whole stack
+            ts = np.broadcast_to(ts, (len(self.vs), len(ts)))
+        if self.n == 1:
+            return np.broadcast_to(self.vs[..., :1, :], (*ts.shape, 3)).copy()
+        if self.n == 2:
+            return (1-ts[..., None])*self.vs[..., :1, :] + ts[..., None]*self.vs[..., 1:, :]
+        scaled = ts*(self.n - 1)
+        low = np.floor(scaled).astype(np.int64)
+        high = np.ceil(scaled).astype(np.int64)
+        nxt = np.minimum(low + 1, self.n - 1)
+        take = lambda table, inds: np.take_along_axis(table, np.broadcast_to(inds[..., None], (*inds.shape, 3)), axis = -2)
+        if self.vs.ndim == 2:
+            take = lambda table, inds: table[inds]
+        cats = hermite(take(self.vs, low), take(self.ms, low), take(self.vs, nxt), take(self.ms, nxt), scaled - low)
+        on_vertex = low == high
+        cats[on_vertex] = take(self.vs, low)[on_vertex]
+        return cats
+
+    def arc_table(self, res: int, t_max) -> tuple[np.ndarray, np.ndarray]:
+        """ <res> parameters from 0 to <t_max> (a float, or one per curve) and the arc length reached at each"""
+        ts = np.linspace(0, np.asarray(t_max, dtype = float), res, axis = -1)
+        return ts, distance_accumulate(self(ts))
+
+    def even(self, res: int, t_max) -> np.ndarray:
+        """ <res> points evenly spaced by arc length along each curve, up to the parameter <t_max>"""
+        ts, distances = self.arc_table(res, t_max)
+        even_distances = np.linspace(0, distances[..., -1], res, axis = -1)
+        if distances.ndim == 1:
+            even_times = np.interp(even_distances, distances, ts)
+        else:
+            even_times = interp_batch(even_distances, distances, np.broadcast_to(ts, distances.shape))
+        return self(even_times)
+
+def catmull(vs: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """ The catmull-rom curve(s) through <vs> at global parameters <ts>"""
+    return catmullCurves(vs)(ts)
+
+# resamples catmull spline with t_max in (0, 1] cutoff
+def even_catmull(vs: np.ndarray, res: int, t_max) -> np.ndarray:
+    """ <res> arc-length-even points of the curve(s) through <vs> up to parameter <t_max> (a float, or one per curve)"""
+    return catmullCurves(vs).even(res, t_max)
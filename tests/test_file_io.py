@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+script_dir = os.path.dirname(__file__)
+mymodules_dir = os.path.join(script_dir, '..', 'src')
+sys.path.append(mymodules_dir)
+
+import file_io as io
+
+def random_strands(rng, n_strands = 50):
+    lengths = rng.integers(2, 40, n_strands)
+    verts = rng.normal(size = (int(np.sum(lengths)), 3))
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    return verts, [np.arange(b0, b1) for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+def test_iter_obj_strands_matches_read_obj(tmp_path):
+    verts, strands = random_strands(np.random.default_rng(0))
+    path = str(tmp_path / "strands.obj")
+    io.export_obj(verts, strands, path, mtllib = "strands.mtl", material = "HairMaterial")
+    streamed = list(io.iter_obj_strands(path, start_size = 4))
+    assert len(streamed) == len(strands)
+    for got, strand in zip(streamed, strands):
+        np.testing.assert_array_equal(got, verts[strand])
+
+def test_iter_obj_strands_rejects_strands_out_of_order(tmp_path):
+    verts, strands = random_strands(np.random.default_rng(1), 5)
+    path = str(tmp_path / "reversed.obj")
+    io.export_obj(verts, strands[::-1], path)
+    with pytest.raises(ValueError):
+        list(io.iter_obj_strands(path))
@@ -13,6 +13,9 @@ type Preset = {
   groupingCSV: string;
 };
 
+// URLs of the .obj/.mtl pair the API wrote for one generation (each request gets its own)
+type HairUrls = { objUrl: string; mtlUrl: string };
+
 const presets: Preset[] = [
   {
     name: "Side Swatch",
@@ -39,6 +42,8 @@ export default function App() {
   const [color, setColor] = useState("#000000");
   const [params, setParams] = useState({ curliness: 0.5, length: 1.0, density: 1.0 });
   const [showScalp, setShowScalp] = useState(true);
+  const [hairUrls, setHairUrls] = useState<HairUrls | null>(null);
+  const hairUrlsRef = useRef<HairUrls | null>(null);
 
   const [physicsOn, setPhysicsOn] = useState(false);
   const [gravityStrength, setGravityStrength] = useState(0.01);
@@ -167,34 +172,35 @@ export default function App() {
           guidePath: selectedPreset.guidePath,
           scalpPath: selectedPreset.scalpPath,
           groupingCSV: selectedPreset.groupingCSV.replace(/r\d+/, `r${groupingRadius}`),
-          outputPath: "output/strands.obj",
           ...params,
           color: color,
         }),
       });
       const data = await response.json();
+      if (!response.ok) throw new Error(data.detail);
+      const urls = { objUrl: data.objUrl, mtlUrl: data.mtlUrl };
+      hairUrlsRef.current = urls;
+      setHairUrls(urls);
       setLog(`Geração concluída: ${data.message || "OK"}`);
+      if (sceneRef.current) loadHairModel(sceneRef.current, urls);
     } catch (error) {
       setLog("Erro ao gerar cabelo.");
     } finally {
       setLoading(false);
     }
-
-    if (sceneRef.current) loadHairModel(sceneRef.current);
   };
 
 
-  const loadHairModel = (scene: THREE.Scene) => {
+  const loadHairModel = (scene: THREE.Scene, urls: HairUrls | null = hairUrlsRef.current) => {
+    if (!urls) return; // nothing generated yet
     const mtlLoader = new MTLLoader();
     const timestamp = Date.now();
-    mtlLoader.setPath("http://localhost:8000/output/");
-    mtlLoader.load(`strands.mtl?t=${timestamp}`, (materials) => {
+    mtlLoader.load(`http://localhost:8000${urls.mtlUrl}?t=${timestamp}`, (materials) => {
       materials.preload();
 
       const objLoader = new OBJLoader();
       objLoader.setMaterials(materials);
-      objLoader.setPath("http://localhost:8000/output/");
-      objLoader.load("strands.obj", (obj) => {
+      objLoader.load(`http://localhost:8000${urls.objUrl}?t=${timestamp}`, (obj) => {
         obj.scale.set(0.05, 0.05, 0.05);
 
         const existing = scene.getObjectByName("HairModel");
@@ -308,9 +314,11 @@ export default function App() {
             {loading ? "⏳ Generating..." : "✨ Generate Hair"}
           </button>
 
-          <a href="http://localhost:8000/output/strands.obj" download="generated_hair.obj" className="download-button">
-            ⬇️ Download .obj
-          </a>
+          {hairUrls && (
+            <a href={`http://localhost:8000${hairUrls.objUrl}`} download="generated_hair.obj" className="download-button">
+              ⬇️ Download .obj
+            </a>
+          )}
 
           {loading && <div className="loader"></div>}
           <p className="log">{log}</p>